@@ -3,27 +3,45 @@ import hmac
 from hashlib import sha256, md5
 import uuid
 from decimal import Decimal
-from datetime import datetime
 from urllib.parse import urlencode
 import logging
-import time
-import random
 from types import SimpleNamespace
 
-import aiosqlite
-from quart import Quart, request, redirect, url_for, make_response, jsonify, send_from_directory, session, render_template
+from quart import Quart, request, redirect, url_for, make_response, jsonify, session, render_template
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
 from joserfc.errors import JoseError
-from sqlalchemy import select, text
+from sqlalchemy import select, text, update, exists, literal
 import httpx
 
 from config import Config
-from models import AuthToken, Card, Season, Comment, AllowedUser, Order
-from async_db import get_async_session, get_sqlite_conn, SQLITE_DB_PATH
+from models import AuthToken, Card, Season, AllowedUser, Order
+from async_db import get_async_session, get_readonly_session, get_sqlite_conn, sqlite_pool, pg_pool_metrics
+from catalog import catalog
+from ownership import ownership
+from grants import grant_order, line_quantity
+from fulfillment import notify_bot_purchase, mark_order_paid, fulfillment_worker
+from notify_outbox import outbox_sender
+from reconcile import order_reconciler
+from uploads import save_card_image, remove_card_image, limit_upload, UploadTooLarge, UnsupportedImage
+from image_derivatives import image_derivatives, Unrenderable
+import static_delivery
+from static_delivery import send_static
+from sqlite_writer import sqlite_writer
+import http_cache
+import json_provider
+from auth_cache import token_cache, permission_cache
+from http_clients import http_clients
+from avatar_cache import avatar_cache, is_allowed_url, AvatarFetchError, AvatarTooLarge
+from card_queries import CardListQuery, InvalidQuery
+from comments import fetch_comments, comment_counts, MAX_PAGE_SIZE as MAX_COMMENT_PAGE_SIZE, MAX_COUNT_CARDS
 
 logging.basicConfig(level=logging.DEBUG)
 
 app = Quart(__name__)
 app.config.from_object(Config)
+app.response_class = static_delivery.Response
+json_provider.install(app)
 # Quart session (cookie-based)
 try:
     from quart.sessions import SecureCookieSessionInterface
@@ -34,7 +52,13 @@ except Exception:
 
 @app.route("/placeholder.jpg")
 async def serve_placeholder():
-    return await send_from_directory("public", "placeholder.jpg")
+    return await send_static("public", "placeholder.jpg", "public")
+
+
+async def _load_token_user_id(token):
+    async with get_readonly_session() as db_session:
+        r = await db_session.execute(select(AuthToken.user_id).where(AuthToken.token == token))
+        return r.scalar_one_or_none()
 
 
 async def is_authenticated(req, sess):
@@ -43,20 +67,53 @@ async def is_authenticated(req, sess):
         logging.debug("No token found in request")
         return False, None
     try:
-        async with get_async_session() as db_session:
-            r = await db_session.execute(select(AuthToken).where(AuthToken.token == token))
-            auth_token = r.scalar_one_or_none()
-        if auth_token is None:
-            logging.debug("Token not found in database")
+        user_id = await token_cache.get_user_id(token, _load_token_user_id)
+        if user_id is None:
+            logging.debug("Token not found")
             return False, None
-        sess["user_id"] = auth_token.user_id
-        logging.debug("Token is valid (database check)")
-        return True, auth_token.user_id
+        sess["user_id"] = user_id
+        logging.debug("Token is valid")
+        return True, user_id
     except Exception as e:
         logging.exception(f"Authentication error: {e}")
         return False, None
 
 
+async def _load_allowed(username):
+    async with get_readonly_session() as db_session:
+        r = await db_session.execute(select(exists().where(AllowedUser.username == username)))
+        return r.scalar()
+
+
+async def _authorize_admin(db_session, message):
+    """
+    token -> user -> allowed_user check for admin routes, on the caller's session so the
+    target row is loaded in the same unit of work. Served from the auth caches when warm,
+    otherwise a single query. Returns an error response, or None if the user is allowed.
+    """
+    token = request.args.get("token") or request.cookies.get("token")
+    if not token:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session.get("telegram_username")
+    generation = token_cache.generation
+    token_hit, user_id = token_cache.peek(token)
+    allowed_hit, allowed = permission_cache.peek(username) if username else (True, False)
+    if not (token_hit and allowed_hit):
+        token_user = select(AuthToken.user_id).where(AuthToken.token == token).scalar_subquery()
+        is_allowed = exists().where(AllowedUser.username == username) if username else literal(False)
+        r = await db_session.execute(select(token_user, is_allowed))
+        user_id, allowed = r.one()
+        token_cache.remember(token, user_id, generation)
+        if username:
+            permission_cache.remember(username, allowed)
+    if user_id is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    session["user_id"] = user_id
+    if not allowed:
+        return jsonify({"error": message}), 403
+    return None
+
+
 async def download_avatar(url, user_id):
     if not url:
         return None
@@ -64,11 +121,10 @@ async def download_avatar(url, user_id):
     os.makedirs(avatar_dir, exist_ok=True)
     filename = os.path.join(avatar_dir, f"{user_id}.jpg")
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            with open(filename, "wb") as f:
-                f.write(r.content)
+        r = await http_clients.telegram.get(url)
+        r.raise_for_status()
+        with open(filename, "wb") as f:
+            f.write(r.content)
         return filename
     except httpx.HTTPError as e:
         logging.error(f"Error downloading avatar from {url}: {e}")
@@ -104,6 +160,7 @@ async def telegram_callback():
     try:
         async with get_async_session() as db_session:
             db_session.add(auth_token)
+        token_cache.remember(db_token, user_id)
         logging.debug(f"Stored token {db_token} for user {user_id} in database")
     except Exception as e:
         logging.exception(f"Database error saving token: {e}")
@@ -129,6 +186,7 @@ async def logout():
                 auth_token = r.scalar_one_or_none()
                 if auth_token:
                     await db_session.delete(auth_token)
+            await token_cache.invalidate(token)
             logging.debug(f"Deleted token {token} from database")
         except Exception as e:
             logging.exception(f"Database error deleting token: {e}")
@@ -140,6 +198,71 @@ async def logout():
     return response
 
 
+@app.before_serving
+async def start_auth_cache():
+    await token_cache.start()
+
+
+@app.after_serving
+async def close_sqlite_pool():
+    await sqlite_pool.close()
+
+
+@app.after_serving
+async def close_sqlite_writer():
+    await sqlite_writer.close()
+
+
+@app.after_serving
+async def stop_auth_cache():
+    await token_cache.stop()
+
+
+@app.before_serving
+async def start_http_clients():
+    await http_clients.start()
+
+
+@app.before_serving
+async def start_fulfillment_worker():
+    await fulfillment_worker.start()
+
+
+@app.after_serving
+async def stop_fulfillment_worker():
+    await fulfillment_worker.stop()
+
+
+@app.before_serving
+async def start_outbox_sender():
+    await outbox_sender.start()
+
+
+@app.after_serving
+async def stop_outbox_sender():
+    await outbox_sender.stop()
+
+
+@app.before_serving
+async def start_order_reconciler():
+    await order_reconciler.start()
+
+
+@app.after_serving
+async def stop_order_reconciler():
+    await order_reconciler.stop()
+
+
+@app.after_serving
+async def close_image_derivatives():
+    await image_derivatives.close()
+
+
+@app.after_serving
+async def close_http_clients():
+    await http_clients.close()
+
+
 @app.after_request
 async def apply_csp(response):
     response.headers["Content-Security-Policy"] = (
@@ -149,6 +272,16 @@ async def apply_csp(response):
     return response
 
 
+@app.before_request
+async def conditional_get():
+    return await http_cache.not_modified(request)
+
+
+@app.after_request
+async def apply_cache_headers(response):
+    return await http_cache.apply_cache_headers(request, response)
+
+
 @app.route("/")
 async def return_home():
     return redirect(url_for("home"))
@@ -160,7 +293,6 @@ async def login():
     if is_auth:
         return redirect(url_for("home"))
     if request.args.get("check_auth"):
-        is_auth, user_id = await is_authenticated(request, session)
         return jsonify({"type": "auth-status", "isAuthenticated": is_auth, "userId": user_id}), 200
     return jsonify({"type": "auth-status", "isAuthenticated": False, "userId": None}), 200
 
@@ -177,7 +309,7 @@ async def home():
 @app.route("/db-status")
 async def db_status():
     try:
-        async with get_async_session() as db_session:
+        async with get_readonly_session() as db_session:
             r = await db_session.execute(text("SELECT version()"))
             pg_version = r.scalar_one()
         async with get_sqlite_conn() as conn:
@@ -193,64 +325,86 @@ async def db_status():
         "postgres_version": pg_version,
         "sqlite_version": sqlite_version,
         "cards_count": cards_count,
+        "pg_pool": pg_pool_metrics(),
+        "sqlite_pool": sqlite_pool.stats(),
+        "catalog": catalog.stats(),
+        "catalog_responses": http_cache.encoded_responses.stats(),
+        "ownership": ownership.stats(),
+        "auth_cache": token_cache.stats(),
+        "permission_cache": permission_cache.stats(),
+        "http_clients": http_clients.stats(),
+        "avatar_cache": avatar_cache.stats(),
+        "image_derivatives": image_derivatives.stats(),
+        "sqlite_writer": sqlite_writer.stats(),
+        "fulfillment": fulfillment_worker.stats(),
+        "notify_outbox": outbox_sender.stats(),
+        "reconcile": order_reconciler.stats(),
     })
 
 
 @app.route("/card_imgs/<filename>")
 async def serve_card_image(filename):
-    return await send_from_directory("card_imgs", filename)
+    try:
+        variant = image_derivatives.parse(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if variant is None or not image_derivatives.available:
+        return await send_static("card_imgs", filename, "card_imgs")
+    # Only regular files directly in card_imgs ("." and ".." would reach the renderer as directories)
+    source = safe_join("card_imgs", filename)
+    if source is None or os.path.basename(filename) != filename or not os.path.isfile(source):
+        return "Not found", 404
+    try:
+        path, content_type, etag = await image_derivatives.get(filename, *variant)
+    except OSError:
+        # Removed or replaced between the check and the read
+        return "Not found", 404
+    except Unrenderable as e:
+        # Animated GIFs and formats this Pillow build cannot write: the original is the best we have
+        logging.debug(f"Serving original {filename} instead of variant {variant}: {e}")
+        return await send_static("card_imgs", filename, "card_imgs")
+    if request.if_none_match.contains(etag):
+        response = await make_response("", 304)
+    else:
+        response = await send_static(image_derivatives.cache_dir, os.path.basename(path), "card_img_cache", mimetype=content_type)
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/api/seasons")
 async def get_seasons():
     try:
-        async with get_sqlite_conn() as conn:
-            cur = await conn.execute("SELECT DISTINCT season FROM cards WHERE season IS NOT NULL")
-            rows = await cur.fetchall()
-            seasons = [row[0] for row in rows]
-        return jsonify(sorted(seasons)), 200
+        snap = await catalog.get()
+        return jsonify(snap.seasons), 200
     except Exception as e:
         logging.error(f"Database error: {str(e)}")
         return jsonify({"error": "Failed to fetch seasons"}), 500
 
 @app.route("/api/seasons", methods=["POST"])
 async def add_season():
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    current_user_username = session.get("telegram_username")
-    async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == current_user_username))
-        allowed_user = r.scalar_one_or_none()
-    if not current_user_username or not allowed_user:
-        return jsonify({"error": "You are not allowed to add seasons"}), 403
     new_season_uuid = str(uuid.uuid4())
     new_season = Season(uuid=new_season_uuid, name="_")
     async with get_async_session() as db_session:
+        denied = await _authorize_admin(db_session, "You are not allowed to add seasons")
+        if denied:
+            return denied
         db_session.add(new_season)
     return jsonify({"message": "Season added successfully", "uuid": new_season_uuid, "name": new_season.name}), 201
 
 @app.route("/api/seasons/<season_uuid>", methods=["PUT"])
 async def update_season(season_uuid):
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    current_user_username = session.get("telegram_username")
-    async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == current_user_username))
-        if not current_user_username or r.scalar_one_or_none() is None:
-            return jsonify({"error": "You are not allowed to update seasons"}), 403
-        s = await db_session.execute(select(Season).where(Season.uuid == season_uuid))
-        season = s.scalar_one_or_none()
-    if not season:
-        return jsonify({"error": "Season not found"}), 404
-    data = await request.get_json()
-    if not data:
-        return jsonify({"error": "No data provided"}), 400
+    data = await request.get_json(silent=True)
     try:
         async with get_async_session() as db_session:
+            denied = await _authorize_admin(db_session, "You are not allowed to update seasons")
+            if denied:
+                return denied
             s = await db_session.execute(select(Season).where(Season.uuid == season_uuid))
-            season = s.scalar_one()
+            season = s.scalar_one_or_none()
+            if not season:
+                return jsonify({"error": "Season not found"}), 404
+            if not data:
+                return jsonify({"error": "No data provided"}), 400
             if "name" in data:
                 season.name = data["name"]
         return jsonify({"message": "Season updated successfully", "uuid": season.uuid, "name": season.name}), 200
@@ -260,14 +414,10 @@ async def update_season(season_uuid):
 
 @app.route("/api/seasons/<season_uuid>", methods=["DELETE"])
 async def delete_season(season_uuid):
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    current_user_username = session.get("telegram_username")
     async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == current_user_username))
-        if not current_user_username or r.scalar_one_or_none() is None:
-            return jsonify({"error": "You are not allowed to delete seasons"}), 403
+        denied = await _authorize_admin(db_session, "You are not allowed to delete seasons")
+        if denied:
+            return denied
         s = await db_session.execute(select(Season).where(Season.uuid == season_uuid))
         season = s.scalar_one_or_none()
         if not season:
@@ -275,63 +425,60 @@ async def delete_season(season_uuid):
         await db_session.delete(season)
     return jsonify({"message": "Season deleted successfully"}), 200
 
+def _includes(args):
+    return {part.strip() for part in args.get("include", "").split(",") if part.strip()}
+
+
+def _season_counts(snap, owned, season_id):
+    """Ownership counts restricted to one season's cards, for plans that bind counts."""
+    return {cid: owned[cid] for cid in snap.by_season.get(season_id, ()) if cid in owned}
+
+
 @app.route("/api/cards/<season_id>")
 async def get_cards(season_id):
-    RARITY_ORDER = {
-        "EPISODICAL": 1, "SECONDARY": 2, "FAMOUS": 3, "MAINCHARACTER": 4,
-        "MOVIE": 5, "SERIES": 6, "ACHIEVEMENTS": 7,
-    }
     try:
-        sort_field = request.args.get("sort", "id")
-        sort_direction = request.args.get("direction", "asc")
-        async with get_sqlite_conn() as conn:
-            if sort_field == "rarity":
-                cur = await conn.execute(
-                    "SELECT id, photo, name, rarity, points FROM cards WHERE season = ?",
-                    (int(season_id),),
-                )
-                rows = await cur.fetchall()
-                cards = [dict(zip(["id", "img", "name", "rarity", "points"], row)) for row in rows]
-                cards.sort(key=lambda x: RARITY_ORDER.get(x["rarity"], 0))
-                if sort_direction.lower() == "desc":
-                    cards.reverse()
-                return jsonify(cards), 200
-            elif sort_field == "amount":
-                query = """
-                    SELECT c.id, c.photo, c.name, c.rarity, c.points, COUNT(f.card_id) as amount
-                    FROM cards c LEFT JOIN filmstrips f ON c.id = f.card_id
-                    WHERE c.season = ? GROUP BY c.id, c.photo, c.name, c.rarity, c.points
-                    ORDER BY amount {}
-                """.format(sort_direction)
-                cur = await conn.execute(query, (int(season_id),))
-                rows = await cur.fetchall()
-                cards = [dict(zip(["id", "img", "name", "rarity", "points", "amount"], row)) for row in rows]
-                return jsonify(cards), 200
-            else:
-                query = """
-                    SELECT id, id as uuid, photo as img, name, rarity, points
-                    FROM cards WHERE season = ? ORDER BY {} {}
-                """.format(sort_field, sort_direction)
-                cur = await conn.execute(query, (int(season_id),))
-                rows = await cur.fetchall()
-                cards = [dict(zip(["id", "uuid", "img", "name", "rarity", "points"], row)) for row in rows]
-                return jsonify(cards), 200
+        query = CardListQuery(
+            int(season_id),
+            sort=request.args.get("sort", "id"),
+            direction=request.args.get("direction", "asc"),
+            fields=request.args.get("fields"),
+            limit=request.args.get("limit"),
+            cursor=request.args.get("cursor"),
+        )
+    except InvalidQuery as e:
+        return jsonify({"error": str(e)}), 400
     except ValueError:
         return jsonify({"error": "Invalid season ID"}), 400
+    try:
+        counts = None
+        if query.needs_counts:
+            snap = await catalog.get()
+            owned = await ownership.get()
+            counts = _season_counts(snap, owned, query.season_id)
+        async with get_sqlite_conn() as conn:
+            async with conn.execute(query.sql, query.bind(counts)) as cur:
+                rows = await cur.fetchall()
+        cards, next_cursor = query.page(rows)
+        if "comment_count" in _includes(request.args):
+            async with get_readonly_session() as db_session:
+                counts = await comment_counts(db_session, [c["id"] for c in cards])
+            for c in cards:
+                c["comment_count"] = counts.get(c["id"], 0)
+        if query.paginated:
+            return jsonify({"cards": cards, "next_cursor": next_cursor}), 200
+        return jsonify(cards), 200
     except Exception as e:
         logging.error(f"Error fetching cards: {str(e)}")
         return jsonify({"error": "Failed to fetch cards"}), 500
 
 @app.route("/api/cards", methods=["POST"])
 async def add_card():
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    current_user_username = session.get("telegram_username")
-    async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == current_user_username))
-        if not current_user_username or r.scalar_one_or_none() is None:
-            return jsonify({"error": "You are not allowed to add cards"}), 403
+    async with get_readonly_session() as db_session:
+        denied = await _authorize_admin(db_session, "You are not allowed to add cards")
+    if denied:
+        return denied
+    if limit_upload(request):
+        return jsonify({"error": "Image too large"}), 413
     form = await request.form
     files = await request.files
     card_uuid = form.get("uuid")
@@ -340,23 +487,20 @@ async def add_card():
     description = form.get("description")
     season_id = form.get("season_id")
     img_file = files.get("img")
-    img = None
-    if img_file and getattr(img_file, "filename", None):
-        allowed_extensions = {"png", "jpg", "jpeg", "gif"}
-        if "." not in img_file.filename or img_file.filename.rsplit(".", 1)[1].lower() not in allowed_extensions:
-            return jsonify({"error": "Unsupported file type"}), 400
-        img_filename = str(card_uuid) + os.path.splitext(img_file.filename)[1]
-        img_path = os.path.join("card_imgs", img_filename)
-        body = await img_file.read()
-        with open(img_path, "wb") as f:
-            f.write(body)
-        img = img_filename
-    if not all([card_uuid, img, category, name, description, season_id]):
+    has_img = img_file is not None and getattr(img_file, "filename", None)
+    if not all([card_uuid, has_img, category, name, description, season_id]):
         return jsonify({"error": "Missing required fields"}), 400
+    try:
+        img = await save_card_image(img_file, card_uuid)
+    except UnsupportedImage:
+        return jsonify({"error": "Unsupported file type"}), 400
+    except UploadTooLarge:
+        return jsonify({"error": "Image too large"}), 413
     new_card = Card(uuid=card_uuid, img=img, category=category, name=name, description=description, season_id=int(season_id))
     try:
         async with get_async_session() as db_session:
             db_session.add(new_card)
+        image_derivatives.pregenerate(img)
         return jsonify({"message": "Card added successfully", "uuid": new_card.uuid}), 201
     except Exception as e:
         logging.error(f"Error adding card: {e}")
@@ -364,21 +508,16 @@ async def add_card():
 
 @app.route("/api/cards/<card_id>", methods=["DELETE"])
 async def delete_card(card_id):
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    current_user_username = session.get("telegram_username")
     async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == current_user_username))
-        if not current_user_username or r.scalar_one_or_none() is None:
-            return jsonify({"error": "You are not allowed to delete cards"}), 403
+        denied = await _authorize_admin(db_session, "You are not allowed to delete cards")
+        if denied:
+            return denied
         c = await db_session.execute(select(Card).where(Card.uuid == card_id))
         card = c.scalar_one_or_none()
         if card is None:
             return jsonify({"error": "Card not found"}), 404
-        if card.img and os.path.exists(os.path.join("card_imgs", card.img)):
-            os.remove(os.path.join("card_imgs", card.img))
         await db_session.delete(card)
+    await remove_card_image(card.img)
     return jsonify({"message": "Card deleted successfully"}), 200
 
 @app.route("/api/check_permission", methods=["GET"])
@@ -386,29 +525,50 @@ async def check_permission():
     username = request.args.get("username")
     if not username:
         return jsonify({"error": "Username not provided"}), 400
-    async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == username))
-        user = r.scalar_one_or_none()
-    return jsonify({"is_allowed": user is not None})
+    is_allowed = await permission_cache.is_allowed(username, _load_allowed)
+    return jsonify({"is_allowed": is_allowed})
     
+def _card_info_payload(card, card_count, card_id=None):
+    card_id = str(card.id) if card_id is None else card_id
+    return {
+        "id": card_id, "uuid": card_id, "season_id": card.season, "img": card.photo,
+        "category": card.rarity, "name": card.name, "description": f"Amount: {card_count}",
+    }
+
+
+MAX_BATCH_IDS = 200
+
+
+@app.route("/api/card_info")
+async def get_card_info_batch():
+    """Card info for several cards at once: /api/card_info?ids=1,2,3 (unknown ids are skipped)."""
+    try:
+        ids = [int(x) for x in request.args.get("ids", "").split(",") if x.strip()]
+    except ValueError:
+        return jsonify({"error": "Invalid card ID"}), 400
+    if not ids:
+        return jsonify({"error": "No card IDs provided"}), 400
+    if len(ids) > MAX_BATCH_IDS:
+        return jsonify({"error": f"At most {MAX_BATCH_IDS} card IDs per request"}), 400
+    try:
+        snap = await catalog.get()
+        counts = await ownership.get()
+        cards = (snap.cards_by_id.get(cid) for cid in dict.fromkeys(ids))
+        return jsonify([_card_info_payload(c, counts.get(c.id, 0)) for c in cards if c is not None]), 200
+    except Exception as e:
+        logging.error(f"SQLite error: {str(e)}")
+        return jsonify({"error": "Failed to fetch card info"}), 500
+
+
 @app.route("/api/card_info/<card_id>")
 async def get_card_info(card_id):
     try:
-        async with get_sqlite_conn() as conn:
-            cur = await conn.execute(
-                "SELECT photo, name, rarity, points, number, [drop], event, season FROM cards WHERE id = ?",
-                (int(card_id),),
-            )
-            row = await cur.fetchone()
-            if not row:
-                return jsonify({"error": "Card not found"}), 404
-            cur2 = await conn.execute("SELECT COUNT(*) FROM filmstrips WHERE card_id = ?", (card_id,))
-            row2 = await cur2.fetchone()
-            card_count = row2[0]
-        return jsonify({
-            "id": card_id, "uuid": card_id, "season_id": row[7], "img": row[0],
-            "category": row[2], "name": row[1], "description": f"Amount: {card_count}",
-        }), 200
+        snap = await catalog.get()
+        card = snap.cards_by_id.get(int(card_id))
+        if card is None:
+            return jsonify({"error": "Card not found"}), 404
+        card_count = await ownership.count(card.id)
+        return jsonify(_card_info_payload(card, card_count, card_id)), 200
     except ValueError:
         return jsonify({"error": "Invalid card ID"}), 400
     except Exception as e:
@@ -417,13 +577,13 @@ async def get_card_info(card_id):
 
 @app.route("/api/cards/<card_id>", methods=["PUT"])
 async def update_card(card_id):
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    data = await request.get_json()
-    if not data:
-        return jsonify({"error": "No data provided"}), 400
+    data = await request.get_json(silent=True)
     async with get_async_session() as db_session:
+        denied = await _authorize_admin(db_session, "You are not allowed to update cards")
+        if denied:
+            return denied
+        if not data:
+            return jsonify({"error": "No data provided"}), 400
         r = await db_session.execute(select(Card).where(Card.id == int(card_id)))
         card = r.scalar_one_or_none()
         if not card:
@@ -444,38 +604,33 @@ async def update_card(card_id):
         
 @app.route("/api/cards/<card_uuid>/image", methods=["PUT"])
 async def update_card_image(card_uuid):
-    is_auth, _ = await is_authenticated(request, session)
-    if not is_auth:
-        return jsonify({"error": "Unauthorized"}), 401
-    current_user_username = session.get("telegram_username")
     async with get_async_session() as db_session:
-        r = await db_session.execute(select(AllowedUser).where(AllowedUser.username == current_user_username))
-        if not current_user_username or r.scalar_one_or_none() is None:
-            return jsonify({"error": "You are not allowed to update card images"}), 403
+        denied = await _authorize_admin(db_session, "You are not allowed to update card images")
+        if denied:
+            return denied
         c = await db_session.execute(select(Card).where(Card.uuid == card_uuid))
         card = c.scalar_one_or_none()
     if not card:
         return jsonify({"error": "Card not found"}), 404
+    if limit_upload(request):
+        return jsonify({"error": "Image too large"}), 413
     files = await request.files
     if "image" not in files:
         return jsonify({"error": "No image file provided"}), 400
     img_file = files["image"]
-    allowed_extensions = {"png", "jpg", "jpeg", "gif"}
-    if "." not in img_file.filename or img_file.filename.rsplit(".", 1)[1].lower() not in allowed_extensions:
-        return jsonify({"error": "Unsupported file type"}), 400
-    img_filename = str(card.uuid) + os.path.splitext(img_file.filename)[1].lower()
-    img_path = os.path.join("card_imgs", img_filename)
     try:
-        if card.img and os.path.exists(os.path.join("card_imgs", card.img)) and card.img != img_filename:
-            os.remove(os.path.join("card_imgs", card.img))
-        body = await img_file.read()
-        with open(img_path, "wb") as f:
-            f.write(body)
+        # New file is renamed into place first; the old one goes only once the row points elsewhere
+        img_filename = await save_card_image(img_file, card.uuid)
         async with get_async_session() as db_session:
-            c = await db_session.execute(select(Card).where(Card.uuid == card_uuid))
-            card = c.scalar_one()
-            card.img = img_filename
+            await db_session.execute(update(Card).where(Card.uuid == card_uuid).values(img=img_filename))
+        if card.img and card.img != img_filename:
+            await remove_card_image(card.img)
+        image_derivatives.pregenerate(img_filename)
         return jsonify({"message": "Card image updated successfully", "img": img_filename}), 200
+    except UnsupportedImage:
+        return jsonify({"error": "Unsupported file type"}), 400
+    except UploadTooLarge:
+        return jsonify({"error": "Image too large"}), 413
     except Exception as e:
         logging.error(f"Error updating card image: {e}")
         return jsonify({"error": "Error updating card image"}), 500
@@ -484,8 +639,10 @@ async def update_card_image(card_uuid):
 async def get_season_info(season_id):
     try:
         season_num = int(season_id)
-        season_info = {"id": season_num, "uuid": season_num, "name": "Season " + str(season_num)}
-        return jsonify(season_info), 200
+        snap = await catalog.get()
+        if season_num not in snap.by_season:
+            return jsonify({"error": "Season not found"}), 404
+        return jsonify(_season_info_payload(season_num)), 200
     except ValueError:
         return jsonify({"error": "Invalid season ID format"}), 400
     except Exception as e:
@@ -493,14 +650,82 @@ async def get_season_info(season_id):
         return jsonify({"error": "Failed to fetch season info"}), 500
 
 
+def _season_info_payload(season_num):
+    return {"id": season_num, "uuid": season_num, "name": "Season " + str(season_num)}
+
+
+@app.route("/api/catalog")
+async def get_catalog():
+    """
+    All seasons with their info and card counts in one response.
+    With ?cards=<n> every season also carries its first page of cards
+    ({cards, next_cursor}); sort/direction/fields apply as in /api/cards.
+    """
+    page_size = request.args.get("cards")
+    try:
+        snap = await catalog.get()
+        queries = {}
+        if page_size:
+            for season_num in snap.seasons:
+                queries[season_num] = CardListQuery(
+                    season_num,
+                    sort=request.args.get("sort", "id"),
+                    direction=request.args.get("direction", "asc"),
+                    fields=request.args.get("fields"),
+                    limit=page_size,
+                )
+    except InvalidQuery as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        owned = await ownership.get() if any(q.needs_counts for q in queries.values()) else None
+        seasons = []
+        async with get_sqlite_conn() as conn:
+            for season_num in snap.seasons:
+                info = _season_info_payload(season_num)
+                info["card_count"] = len(snap.by_season[season_num])
+                query = queries.get(season_num)
+                if query is not None:
+                    counts = _season_counts(snap, owned, season_num) if owned is not None else None
+                    async with conn.execute(query.sql, query.bind(counts)) as cur:
+                        rows = await cur.fetchall()
+                    cards, next_cursor = query.page(rows)
+                    info["cards"] = {"cards": cards, "next_cursor": next_cursor}
+                seasons.append(info)
+        return jsonify({"seasons": seasons}), 200
+    except Exception as e:
+        logging.error(f"Error fetching catalog: {e}")
+        return jsonify({"error": "Failed to fetch catalog"}), 500
+
+
+@app.route("/api/comments/counts")
+async def get_comment_counts():
+    try:
+        card_ids = [int(c) for c in request.args.get("cards", "").split(",") if c.strip()]
+    except ValueError:
+        return jsonify({"error": "Invalid card ID"}), 400
+    if len(card_ids) > MAX_COUNT_CARDS:
+        return jsonify({"error": f"At most {MAX_COUNT_CARDS} cards per request"}), 400
+    async with get_readonly_session() as db_session:
+        counts = await comment_counts(db_session, card_ids)
+    return jsonify({"counts": {str(k): v for k, v in counts.items()}}), 200
+
+
 @app.route("/api/comments/<card_id>")
 async def get_comments(card_id):
-    async with get_async_session() as db_session:
-        stmt = select(Comment).where(Comment.card_id == int(card_id)).order_by(Comment.id)
-        r = await db_session.execute(stmt)
-        comments = r.scalars().all()
-    comments_data = [c.present() for c in comments]
-    return jsonify(comments_data), 200
+    """All comments of a card; with ``limit`` a page ``{"comments", "next_cursor"}`` (pass it back as ``after``)."""
+    try:
+        card_id = int(card_id)
+        limit = request.args.get("limit")
+        limit = max(1, min(int(limit), MAX_COMMENT_PAGE_SIZE)) if limit is not None else None
+        after = request.args.get("after")
+        after = int(after) if after else None
+    except ValueError:
+        return jsonify({"error": "Invalid card ID, limit or cursor"}), 400
+    async with get_readonly_session() as db_session:
+        comments, next_cursor = await fetch_comments(db_session, card_id, limit=limit, after=after)
+    if limit is not None:
+        return jsonify({"comments": comments, "next_cursor": next_cursor}), 200
+    return jsonify(comments), 200
 
 
 @app.route("/api/check_auth")
@@ -594,7 +819,20 @@ async def create_order():
     if not mnt_id or not key:
         logging.warning("PayAnyWay not configured")
         return jsonify({"error": "Payment system is not configured"}), 503
-    total = sum(Decimal(str(it["price"])) * int(it.get("quantity", 1)) for it in items)
+    if not isinstance(items, list):
+        return jsonify({"error": "Invalid items"}), 400
+    total = Decimal(0)
+    for it in items:
+        quantity = line_quantity(it) if isinstance(it, dict) else None
+        if quantity is None:
+            return jsonify({"error": f"Quantity must be an integer from 1 to {Config.ORDER_MAX_QUANTITY}"}), 400
+        try:
+            price = Decimal(str(it["price"]))
+        except (KeyError, ArithmeticError):
+            return jsonify({"error": "Invalid price"}), 400
+        if not price.is_finite() or price < 0:
+            return jsonify({"error": "Invalid price"}), 400
+        total += price * quantity
     order_number = str(uuid.uuid4()).replace("-", "")[:32]
     amount_str = f"{total:.2f}"
     currency = "RUB"
@@ -663,268 +901,9 @@ def _payanyway_callback_verify(data, key):
     )
 
 
-async def _notify_bot_purchase(order, max_retries=3):
-    """
-    Notify purchase_notify service about completed order.
-    Retries up to max_retries times with exponential backoff.
-    Returns (notification_status, notification_error) for persistence.
-    """
-    url = getattr(Config, "BOT_PURCHASE_NOTIFY_URL", None)
-    if not url:
-        logging.info(f"Order {order.order_number}: BOT_PURCHASE_NOTIFY_URL not set, skipping notification")
-        return "skipped", None
-
-    payload = {
-        "event": "purchase_complete",
-        "order_id": order.id,
-        "order_number": order.order_number,
-        "user_id": order.user_id,
-        "items": [
-            {"id": it.get("id"), "name": it.get("name"), "price": float(it.get("price", 0)), "quantity": int(it.get("quantity", 1))}
-            for it in (order.items or [])
-        ],
-        "total_amount": str(order.amount),
-        "currency": order.currency or "RUB",
-        "completed_at": datetime.utcnow().isoformat() + "Z",
-    }
-    headers = {}
-    if getattr(Config, "BOT_PURCHASE_WEBHOOK_SECRET", None):
-        headers["Authorization"] = f"Bearer {Config.BOT_PURCHASE_WEBHOOK_SECRET}"
-    
-    import asyncio
-    last_error = None
-    
-    for attempt in range(1, max_retries + 1):
-        try:
-            async with httpx.AsyncClient() as client:
-                r = await client.post(url, json=payload, headers=headers, timeout=10.0)
-                if r.status_code < 400:
-                    logging.info(f"Order {order.order_number}: Notification sent successfully (attempt {attempt})")
-                    return "sent", None
-                else:
-                    last_error = f"HTTP {r.status_code}: {r.text[:200]}"
-                    logging.warning(f"Order {order.order_number}: Notification failed (attempt {attempt}/{max_retries}): {last_error}")
-        except httpx.HTTPError as e:
-            last_error = str(e)
-            logging.warning(f"Order {order.order_number}: Notification failed (attempt {attempt}/{max_retries}): {last_error}")
-        except Exception as e:
-            last_error = str(e)
-            logging.exception(f"Order {order.order_number}: Unexpected error during notification (attempt {attempt}/{max_retries}): {e}")
-        
-        if attempt < max_retries:
-            wait_time = 2 ** attempt  # Exponential backoff: 2s, 4s, 8s
-            logging.info(f"Order {order.order_number}: Retrying notification in {wait_time}s...")
-            await asyncio.sleep(wait_time)
-    
-    # All retries failed
-    error_msg = (last_error or "unknown")[:512]
-    logging.error(
-        f"Order {order.order_number} (user_id={order.user_id}, amount={order.amount} {order.currency}): "
-        f"Failed to send notification after {max_retries} attempts. Last error: {last_error}. "
-        f"Order is marked as PAID but user may not have received Telegram notification. "
-        f"Manual intervention may be required to grant items or notify user."
-    )
-    return "failed", error_msg
-
-
-async def _grant_test_item(conn: "aiosqlite.Connection", tg_id: int):
-    """Тестовый товар: просто выдаёт карту с id=1."""
-    try:
-        await conn.execute(
-            "INSERT INTO filmstrips (tg_id, card_id) VALUES (?, ?)",
-            (tg_id, 1),
-        )
-        logging.info("Grant: test item -> card_id=1 to tg_id=%s", tg_id)
-    except Exception as e:
-        logging.exception("Grant: failed to give test card to tg_id=%s: %s", tg_id, e)
-
-
-async def _grant_subscription(conn: "aiosqlite.Connection", tg_id: int, premium: bool = False):
-    """
-    Выдача подписки:
-    - устанавливаем subs=True и days=текущее время (как делает rq.changesubs в боте).
-    - для премиум-подписки дополнительно начисляем немного очков магазина.
-    """
-    now_ts = int(time.time())
-    try:
-        cur = await conn.execute("SELECT subs, days, shoppoints FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            logging.warning("Grant: subscription — user tg_id=%s not found in users table", tg_id)
-            return
-        subs, days, shoppoints = row[0], row[1], row[2]
-        # Если подписка уже есть, просто обновим отсчёт 30 дней с текущего момента
-        new_subs = 1
-        new_days = now_ts
-        new_shops = shoppoints
-        if premium:
-            # Премиум даёт дополнительный буст очков магазина
-            bonus = 50000
-            new_shops = (shoppoints or 0) + bonus
-            logging.info("Grant: premium subscription -> +%s shoppoints to tg_id=%s", bonus, tg_id)
-        await conn.execute(
-            "UPDATE users SET subs = ?, days = ?, shoppoints = ? WHERE tg_id = ?",
-            (new_subs, new_days, new_shops, tg_id),
-        )
-        logging.info(
-            "Grant: %s subscription set for tg_id=%s (subs=%s, days=%s, shoppoints=%s)",
-            "premium" if premium else "basic",
-            tg_id,
-            new_subs,
-            new_days,
-            new_shops,
-        )
-    except Exception as e:
-        logging.exception("Grant: failed to set subscription for tg_id=%s: %s", tg_id, e)
-
-
-async def _get_random_card_ids_by_rarity(conn: "aiosqlite.Connection", rarities, count: int):
-    """Возвращает список случайных card_id указанной редкости/редкостей."""
-    if not rarities or count <= 0:
-        return []
-    placeholders = ",".join("?" for _ in rarities)
-    try:
-        cur = await conn.execute(f"SELECT id FROM cards WHERE rarity IN ({placeholders})", tuple(rarities))
-        rows = await cur.fetchall()
-        ids = [r[0] for r in rows]
-        if not ids:
-            logging.warning("Grant: no cards found for rarities=%r", rarities)
-            return []
-        return [random.choice(ids) for _ in range(count)]
-    except Exception as e:
-        logging.exception("Grant: failed to select cards by rarity %r: %s", rarities, e)
-        return []
-
-
-async def _get_random_card_ids_any(conn: "aiosqlite.Connection", count: int):
-    """Случайные карты любой редкости."""
-    if count <= 0:
-        return []
-    try:
-        cur = await conn.execute("SELECT id FROM cards")
-        rows = await cur.fetchall()
-        ids = [r[0] for r in rows]
-        if not ids:
-            logging.warning("Grant: no cards found in cards table")
-            return []
-        return [random.choice(ids) for _ in range(count)]
-    except Exception as e:
-        logging.exception("Grant: failed to select random cards: %s", e)
-        return []
-
-
-async def _insert_cards_for_user(conn: "aiosqlite.Connection", tg_id: int, card_ids):
-    """Добавляет пользователю указанные карты в таблицу filmstrips."""
-    if not card_ids:
-        return
-    try:
-        await conn.executemany(
-            "INSERT INTO filmstrips (tg_id, card_id) VALUES (?, ?)",
-            [(tg_id, cid) for cid in card_ids],
-        )
-        logging.info("Grant: added cards %r to tg_id=%s", card_ids, tg_id)
-    except Exception as e:
-        logging.exception("Grant: failed to insert cards %r for tg_id=%s: %s", card_ids, tg_id, e)
-
-
-async def _grant_pack(conn: "aiosqlite.Connection", tg_id: int, pack_type: str):
-    """
-    Выдаёт награду за покупку пака:
-    - regular: 3 карты EPISODICAL/SECONDARY/FAMOUS, 1 любая карта, 1 MOVIE/SERIES
-    - rare:    4 любых карты, 1 MOVIE/SERIES
-    - epic:    2 любых карты, 3 MOVIE/SERIES
-    """
-    try:
-        if pack_type == "regular":
-            ids_main = await _get_random_card_ids_by_rarity(conn, ["EPISODICAL", "SECONDARY", "FAMOUS"], 3)
-            ids_any = await _get_random_card_ids_any(conn, 1)
-            ids_movie = await _get_random_card_ids_by_rarity(conn, ["MOVIE", "SERIES"], 1)
-            await _insert_cards_for_user(conn, tg_id, ids_main + ids_any + ids_movie)
-        elif pack_type == "rare":
-            ids_any = await _get_random_card_ids_any(conn, 4)
-            ids_movie = await _get_random_card_ids_by_rarity(conn, ["MOVIE", "SERIES"], 1)
-            await _insert_cards_for_user(conn, tg_id, ids_any + ids_movie)
-        elif pack_type == "epic":
-            ids_any = await _get_random_card_ids_any(conn, 2)
-            ids_movie = await _get_random_card_ids_by_rarity(conn, ["MOVIE", "SERIES"], 3)
-            await _insert_cards_for_user(conn, tg_id, ids_any + ids_movie)
-        else:
-            logging.warning("Grant: unknown pack_type=%r for tg_id=%s", pack_type, tg_id)
-    except Exception as e:
-        logging.exception("Grant: failed to grant pack %r for tg_id=%s: %s", pack_type, tg_id, e)
-
-
-async def _grant_movie_home_alone(conn: "aiosqlite.Connection", tg_id: int):
-    """
-    Выдаёт пользователю карту фильма HOME ALONE.
-    Если такой карты нет в таблице cards — выдаём карту id=1.
-    """
-    card_id = None
-    try:
-        cur = await conn.execute(
-            "SELECT id FROM cards WHERE name LIKE ? LIMIT 1",
-            ("%HOME ALONE%",),
-        )
-        row = await cur.fetchone()
-        if row:
-            card_id = row[0]
-        else:
-            logging.warning("Grant: HOME ALONE card not found, fallback to card_id=1")
-            card_id = 1
-    except Exception as e:
-        logging.exception("Grant: failed to find HOME ALONE card: %s", e)
-        card_id = 1
-
-    try:
-        await conn.execute(
-            "INSERT INTO filmstrips (tg_id, card_id) VALUES (?, ?)",
-            (tg_id, card_id),
-        )
-        logging.info("Grant: HOME ALONE card_id=%s granted to tg_id=%s", card_id, tg_id)
-    except Exception as e:
-        logging.exception("Grant: failed to insert HOME ALONE card for tg_id=%s: %s", tg_id, e)
-
-
-async def _grant_career_level(conn: "aiosqlite.Connection", tg_id: int, level: str):
-    """
-    Уровни карьеры (учёба/бизнес) пока не интегрированы в бота напрямую,
-    поэтому реализуем их как заметный бонус очков магазина.
-    """
-    bonus = 0
-    if level == "study":
-        bonus = 100000
-    elif level == "business":
-        bonus = 200000
-    else:
-        logging.warning("Grant: unknown career level %r", level)
-        return
-
-    try:
-        cur = await conn.execute("SELECT shoppoints FROM users WHERE tg_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            logging.warning("Grant: career %s — user tg_id=%s not found", level, tg_id)
-            return
-        shoppoints = row[0] or 0
-        new_shops = shoppoints + bonus
-        await conn.execute(
-            "UPDATE users SET shoppoints = ? WHERE tg_id = ?",
-            (new_shops, tg_id),
-        )
-        logging.info(
-            "Grant: career %s -> +%s shoppoints to tg_id=%s (total=%s)",
-            level,
-            bonus,
-            tg_id,
-            new_shops,
-        )
-    except Exception as e:
-        logging.exception("Grant: failed to grant career %s for tg_id=%s: %s", level, tg_id, e)
-
-
 async def _grant_items_for_order(order):
     """
-    Выдаёт внутриигровые награды за оплаченный заказ.
+    Выдаёт внутриигровые награды за оплаченный заказ (см. grants.PRODUCTS).
     Привязка по order.user_id (tg_id из бота) и item.id из Shop.vue.
     """
     tg_id = order.user_id
@@ -938,50 +917,10 @@ async def _grant_items_for_order(order):
         return
 
     logging.info("Grant: starting grant for order %s, tg_id=%s, items=%r", order.order_number, tg_id, items)
-
-    # Открываем отдельно R/W соединение к той же БД, что использует бот
-    conn = await aiosqlite.connect(SQLITE_DB_PATH)
     try:
-        for it in items:
-            pid = it.get("id")
-            if pid is None:
-                continue
-            try:
-                pid_int = int(pid)
-            except (TypeError, ValueError):
-                logging.warning("Grant: invalid product id %r in order %s", pid, order.order_number)
-                continue
-
-            if pid_int == 7:
-                await _grant_test_item(conn, tg_id)
-            elif pid_int == 1:
-                await _grant_subscription(conn, tg_id, premium=False)
-            elif pid_int == 2:
-                await _grant_subscription(conn, tg_id, premium=True)
-            elif pid_int == 3:
-                await _grant_pack(conn, tg_id, "regular")
-            elif pid_int == 4:
-                await _grant_pack(conn, tg_id, "rare")
-            elif pid_int == 6:
-                await _grant_pack(conn, tg_id, "epic")
-            elif pid_int == 5:
-                await _grant_movie_home_alone(conn, tg_id)
-            elif pid_int == 8:
-                await _grant_career_level(conn, tg_id, "study")
-            elif pid_int == 9:
-                await _grant_career_level(conn, tg_id, "business")
-            else:
-                logging.info("Grant: unknown product id %s in order %s, skipping", pid_int, order.order_number)
-
-        await conn.commit()
+        await grant_order(order)
     except Exception as e:
         logging.exception("Grant: unexpected error while processing order %s: %s", order.order_number, e)
-        try:
-            await conn.rollback()
-        except Exception:
-            pass
-    finally:
-        await conn.close()
 
 
 @app.route("/api/dev/test-grant", methods=["POST"])
@@ -1036,7 +975,7 @@ async def dev_test_grant():
         # Выдаём предметы так же, как при реальной оплате
         await _grant_items_for_order(dummy_order)
         # И шлём уведомление в purchase_notify / бота
-        status, err = await _notify_bot_purchase(dummy_order)
+        status, err = await notify_bot_purchase(dummy_order)
         logging.info(
             "DEV TEST GRANT: notification status=%s err=%r for order %s",
             status,
@@ -1055,28 +994,6 @@ async def dev_test_grant():
     }), 200
 
 
-async def _fulfill_order(order):
-    logging.info(f"Order {order.order_number} fulfilled (items: {order.items})")
-
-    # 1. Выдаём внутриигровые награды
-    try:
-        await _grant_items_for_order(order)
-    except Exception as e:
-        logging.exception("Order %s: error while granting items: %s", order.order_number, e)
-
-    # 2. Уведомляем purchase_notify сервис / бота (Telegram-уведомление пользователю)
-    status, err = await _notify_bot_purchase(order)
-    try:
-        async with get_async_session() as db_session:
-            r = await db_session.execute(select(Order).where(Order.id == order.id))
-            o = r.scalar_one_or_none()
-            if o:
-                o.notification_status = status
-                o.notification_error = err
-    except Exception as e:
-        logging.warning(f"Order {order.order_number}: Could not save notification_status: {e}")
-
-
 @app.route("/api/payment/payanyway/callback", methods=["POST", "GET"])
 async def payanyway_callback():
     # Максимально подробное логирование входящего callback
@@ -1123,53 +1040,42 @@ async def payanyway_callback():
         logging.warning("PayAnyWay callback: invalid signature (expected=%s, got=%s)", expected_sig, mnt_signature)
         return "INVALID_SIGNATURE", 400
 
-    async with get_async_session() as db_session:
-        r = await db_session.execute(select(Order).where(Order.order_number == mnt_transaction_id))
-        order = r.scalar_one_or_none()
+    # Документация MONETA.Assistant: Pay URL получает отчёт о УЖЕ обработанном платеже,
+    # без поля MNT_STATUS. Сам факт прихода отчёта с валидной подписью означает успешный платёж.
+    # Перевод pending -> paid и постановка задачи выдачи — одним условным UPDATE (см. mark_order_paid),
+    # поэтому параллельные повторы MONETA не могут выдать товары дважды.
+    try:
+        async with get_async_session() as db_session:
+            order = await mark_order_paid(
+                db_session, mnt_transaction_id, data.get("MNT_OPERATION_ID") or data.get("MNT_ID")
+            )
+    except Exception as e:
+        logging.exception("PayAnyWay callback commit error for order %r: %s", mnt_transaction_id, e)
+        # В случае внутренней ошибки просим MONETA повторить уведомление.
+        return "FAIL", 200
 
     if not order:
         logging.warning("PayAnyWay callback: order not found %r", mnt_transaction_id)
         # Сообщаем MONETA.Assistant об ошибке, чтобы он мог повторить уведомление
         return "FAIL", 200
 
-    logging.info(
-        "PayAnyWay callback: loaded order id=%s number=%s status=%s amount=%s currency=%s",
-        order.id,
-        order.order_number,
-        order.status,
-        getattr(order, "amount", None),
-        getattr(order, "currency", None),
-    )
-
-    if order.status == "paid":
+    if not order.transitioned:
         # Повторное уведомление о уже оплаченном заказе — просто подтверждаем SUCCESS,
         # чтобы MONETA.Assistant прекратил ретраи.
         logging.info("PayAnyWay callback: order %s already paid, returning SUCCESS", order.order_number)
         return "SUCCESS", 200
 
-    # Документация MONETA.Assistant: Pay URL получает отчёт о УЖЕ обработанном платеже,
-    # без поля MNT_STATUS. Сам факт прихода отчёта с валидной подписью означает успешный платёж.
-    logging.info("PayAnyWay callback: treating processed payment report as successful for order %s", mnt_transaction_id)
-    try:
-        async with get_async_session() as db_session:
-            r = await db_session.execute(select(Order).where(Order.order_number == mnt_transaction_id))
-            order = r.scalar_one()
-            order.status = "paid"
-            order.payanyway_payment_id = data.get("MNT_OPERATION_ID") or data.get("MNT_ID")
-            order.updated_at = datetime.utcnow()
-        logging.info(
-            "PayAnyWay callback: order %s marked as paid (payanyway_payment_id=%r)",
-            order.order_number,
-            order.payanyway_payment_id,
-        )
-        # NOTE: Order is marked "paid" BEFORE notification. If notification fails,
-        # the order remains paid (money already processed by PayAnyWay).
-        # No automatic refunds - monitor logs for notification failures and handle manually.
-        await _fulfill_order(order)
-    except Exception as e:
-        logging.exception("PayAnyWay callback commit error for order %r: %s", mnt_transaction_id, e)
-        # В случае внутренней ошибки просим MONETA повторить уведомление.
-        return "FAIL", 200
+    logging.info(
+        "PayAnyWay callback: order id=%s number=%s amount=%s currency=%s marked as paid, fulfillment queued",
+        order.id,
+        order.order_number,
+        order.amount,
+        order.currency,
+    )
+    # NOTE: Order is marked "paid" BEFORE fulfillment. If granting or notification keeps failing,
+    # the job ends up "failed" and the order remains paid (money already processed by PayAnyWay).
+    # No automatic refunds - monitor fulfillment_jobs / logs and handle manually.
+    fulfillment_worker.wake()
 
     # Важно: для Pay URL текстовым ответом должен быть SUCCESS или FAIL.
     # SUCCESS говорит MONETA.Assistant, что отчёт получен и деньги можно окончательно зачислить.
@@ -1186,8 +1092,8 @@ async def serve_avatar(user_id):
     avatar_dir = "backend/avatars"
     filename = f"{user_id}.jpg"
     try:
-        return await send_from_directory(avatar_dir, filename)
-    except FileNotFoundError:
+        return await send_static(avatar_dir, filename, "avatars")
+    except NotFound:
         return "Avatar not found", 404
 
 
@@ -1197,11 +1103,19 @@ async def proxy_avatar():
     logging.debug(f"Proxying avatar from URL: {url}")
     if not url:
         return "Missing image URL", 400
+    if not is_allowed_url(url):
+        return "Invalid image URL", 400
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url)
-            r.raise_for_status()
-        return r.content, r.status_code, {"Content-Type": r.headers.get("Content-Type", "image/jpeg")}
-    except httpx.HTTPError as e:
+        avatar = await avatar_cache.get(url)
+    except AvatarTooLarge as e:
+        logging.warning(f"Avatar from {url} exceeds size limit: {e}")
+        return "Image too large.", 413
+    except AvatarFetchError as e:
         logging.error(f"Error proxying avatar from {url}: {e}")
-        return "Image not found or could not be downloaded.", 404
\ No newline at end of file
+        return "Image not found or could not be downloaded.", 404
+    if request.if_none_match.contains(avatar.etag):
+        response = await make_response("", 304)
+    else:
+        response = await make_response(avatar.body, 200, {"Content-Type": avatar.content_type})
+    response.set_etag(avatar.etag)
+    return response
\ No newline at end of file
@@ -1,18 +1,86 @@
 """Async DB: PostgreSQL (AsyncSession) and SQLite (aiosqlite) for read-only cards."""
 import os
+import time
+import asyncio
+import logging
 from contextlib import asynccontextmanager
 import aiosqlite
+from sqlalchemy import event, exc, make_url
+from sqlalchemy.engine.interfaces import CacheStats
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config import Config
 
 # PostgreSQL async
+pg_pool_stats = {"checkouts": 0, "wait_total_s": 0.0, "wait_max_s": 0.0, "timeouts": 0}
+# Compiled-statement cache outcome per executed statement (CacheStats name -> count)
+pg_query_cache_stats = {}
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that records how long checkouts wait for a connection."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pg_pool_stats["timeouts"] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            pg_pool_stats["checkouts"] += 1
+            pg_pool_stats["wait_total_s"] += waited
+            pg_pool_stats["wait_max_s"] = max(pg_pool_stats["wait_max_s"], waited)
+
+
+def _pg_url():
+    url = make_url(Config.ASYNC_DATABASE_URI)
+    if url.drivername == "postgresql+asyncpg" and "prepared_statement_cache_size" not in url.query:
+        url = url.update_query_dict({"prepared_statement_cache_size": str(Config.PG_STATEMENT_CACHE_SIZE)})
+    return url
+
+
 async_engine = create_async_engine(
-    Config.ASYNC_DATABASE_URI,
+    _pg_url(),
     echo=os.environ.get("SQL_ECHO", "").lower() in ("1", "true"),
+    poolclass=_TimedQueuePool,
+    pool_size=Config.PG_POOL_SIZE,
+    max_overflow=Config.PG_MAX_OVERFLOW,
+    pool_timeout=Config.PG_POOL_TIMEOUT,
+    pool_recycle=Config.PG_POOL_RECYCLE,
+    pool_pre_ping=Config.PG_POOL_PRE_PING,
+    query_cache_size=Config.PG_QUERY_CACHE_SIZE,
 )
 async_session_factory = async_sessionmaker(
     async_engine, class_=AsyncSession, expire_on_commit=False, autoflush=False
 )
+# Same pool, but no BEGIN/COMMIT round trips: for sessions that only read
+async_readonly_session_factory = async_sessionmaker(
+    async_engine.execution_options(isolation_level="AUTOCOMMIT"), class_=AsyncSession, expire_on_commit=False, autoflush=False
+)
+
+
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def _count_query_cache(conn, cursor, statement, parameters, context, executemany):
+    outcome = CacheStats(context.cache_hit).name.lower() if context.cache_hit is not None else "none"
+    pg_query_cache_stats[outcome] = pg_query_cache_stats.get(outcome, 0) + 1
+    if context.cache_hit == CacheStats.NO_CACHE_KEY:
+        logging.debug(f"Postgres: statement is not cacheable: {statement[:200]}")
+
+
+def pg_pool_metrics():
+    pool = async_engine.sync_engine.pool
+    checkouts = pg_pool_stats["checkouts"]
+    return dict(
+        pg_pool_stats,
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        idle=pool.checkedin(),
+        overflow=max(0, pool.overflow()),
+        wait_avg_s=(pg_pool_stats["wait_total_s"] / checkouts) if checkouts else 0.0,
+        query_cache=dict(pg_query_cache_stats, entries=len(async_engine.sync_engine._compiled_cache or ())),
+    )
 
 
 @asynccontextmanager
@@ -28,16 +96,190 @@ async def get_async_session():
             await session.close()
 
 
+@asynccontextmanager
+async def get_readonly_session():
+    """Session for reads only: autocommit connection, nothing is committed or rolled back."""
+    async with async_readonly_session_factory() as session:
+        yield session
+
+
 # SQLite path (read-only cards DB)
 SQLITE_DB_PATH = getattr(Config, "SQLITE_DB_PATH", "/app/db/offcardswood.db")
 
 
+class _PooledConn:
+    __slots__ = ("conn", "file_id", "data_version", "schema_version")
+
+    def __init__(self, conn, file_id, data_version, schema_version):
+        self.conn = conn
+        self.file_id = file_id
+        self.data_version = data_version
+        self.schema_version = schema_version
+
+
+class SQLiteReadPool:
+    """
+    Bounded pool of warm read-only aiosqlite connections to the bot's DB.
+
+    Every connection is health-checked on checkout. Connections are recycled when
+    the DB file is replaced (new inode) or its schema changes. Commits made by the
+    bot are counted in ``change_counter`` so callers can cheaply tell that the data
+    moved on (``PRAGMA data_version`` is per-connection, so the pool aggregates it).
+    """
+
+    def __init__(self, path, size=4, timeout=10.0, mmap_size=0, cache_size=-2000):
+        self.path = path
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.mmap_size = int(mmap_size)
+        self.cache_size = int(cache_size)
+        self.change_counter = 0
+        self._idle = []
+        self._sem = None  # created on the serving loop
+        self._file_id = None
+        self._in_use = 0
+        self._stats = {
+            "checkouts": 0,
+            "wait_total_s": 0.0,
+            "wait_max_s": 0.0,
+            "timeouts": 0,
+            "opened": 0,
+            "recycled": 0,
+            "health_failures": 0,
+        }
+
+    def _stat_file(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    async def _open(self, file_id):
+        conn = await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            conn.row_factory = aiosqlite.Row
+            await conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+            await conn.execute(f"PRAGMA cache_size = {self.cache_size}")
+            await conn.execute("PRAGMA query_only = ON")
+            data_version, schema_version = await self._versions(conn)
+        except Exception:
+            await conn.close()
+            raise
+        self._stats["opened"] += 1
+        return _PooledConn(conn, file_id, data_version, schema_version)
+
+    @staticmethod
+    async def _versions(conn):
+        async with conn.execute("PRAGMA data_version") as cur:
+            data_version = (await cur.fetchone())[0]
+        async with conn.execute("PRAGMA schema_version") as cur:
+            schema_version = (await cur.fetchone())[0]
+        return data_version, schema_version
+
+    async def _discard(self, entry):
+        self._stats["recycled"] += 1
+        try:
+            await entry.conn.close()
+        except Exception as e:
+            logging.debug(f"SQLite pool: error closing connection: {e}")
+
+    async def _healthy(self, entry):
+        try:
+            data_version, schema_version = await self._versions(entry.conn)
+        except Exception as e:
+            logging.warning(f"SQLite pool: health check failed, recycling connection: {e}")
+            self._stats["health_failures"] += 1
+            return False
+        if schema_version != entry.schema_version:
+            logging.info("SQLite pool: schema changed, recycling connection")
+            return False
+        if data_version != entry.data_version:
+            entry.data_version = data_version
+            self.change_counter += 1
+        return True
+
+    async def _checkout(self):
+        file_id = self._stat_file()
+        if file_id != self._file_id:
+            if self._file_id is not None:
+                logging.info(f"SQLite pool: {self.path} was replaced, recycling {len(self._idle)} idle connections")
+                self.change_counter += 1
+            self._file_id = file_id
+        while self._idle:
+            entry = self._idle.pop()
+            if entry.file_id == file_id and await self._healthy(entry):
+                return entry
+            await self._discard(entry)
+        return await self._open(file_id)
+
+    @asynccontextmanager
+    async def connection(self):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.size)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise
+        waited = time.perf_counter() - started
+        self._stats["checkouts"] += 1
+        self._stats["wait_total_s"] += waited
+        self._stats["wait_max_s"] = max(self._stats["wait_max_s"], waited)
+        try:
+            entry = await self._checkout()
+            self._in_use += 1
+            try:
+                yield entry.conn
+            finally:
+                self._in_use -= 1
+                if entry.file_id == self._file_id and len(self._idle) < self.size:
+                    self._idle.append(entry)
+                else:
+                    await self._discard(entry)
+        finally:
+            self._sem.release()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for entry in idle:
+            await self._discard(entry)
+
+    def signature(self):
+        """Cheap token that changes after any commit to the DB (seen by the pool or via file stats)."""
+        sig = [self.change_counter]
+        for suffix in ("", "-wal"):
+            try:
+                st = os.stat(self.path + suffix)
+                sig.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def stats(self):
+        checkouts = self._stats["checkouts"]
+        return dict(
+            self._stats,
+            size=self.size,
+            in_use=self._in_use,
+            idle=len(self._idle),
+            wait_avg_s=(self._stats["wait_total_s"] / checkouts) if checkouts else 0.0,
+            change_counter=self.change_counter,
+        )
+
+
+sqlite_pool = SQLiteReadPool(
+    SQLITE_DB_PATH,
+    size=Config.SQLITE_POOL_SIZE,
+    timeout=Config.SQLITE_POOL_TIMEOUT,
+    mmap_size=Config.SQLITE_MMAP_SIZE,
+    cache_size=Config.SQLITE_CACHE_SIZE,
+)
+
+
 @asynccontextmanager
 async def get_sqlite_conn():
-    """Async context manager for read-only SQLite (cards)."""
-    conn = await aiosqlite.connect(f"file:{SQLITE_DB_PATH}?mode=ro", uri=True)
-    try:
-        conn.row_factory = aiosqlite.Row
+    """Async context manager for read-only SQLite (cards), served from the pool."""
+    async with sqlite_pool.connection() as conn:
         yield conn
-    finally:
-        await conn.close()
@@ -0,0 +1,206 @@
+"""In-process TTL+LRU caches for auth lookups, with optional cross-worker revocation via Redis."""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+from config import Config
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Small LRU mapping whose entries expire after a per-entry TTL."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=_MISSING):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TokenCache:
+    """
+    token -> user_id cache in front of the ``auth_token`` table.
+
+    Unknown tokens are cached too (``negative_ttl``), so a client retrying with a
+    stale cookie does not hit Postgres every time. ``invalidate`` drops a token
+    locally and, when a Redis URL is configured, in every other worker.
+
+    Every revocation (local, remote or a full clear) bumps ``generation``; a value loaded
+    while the generation changed is returned but not cached, so a lookup that raced a
+    logout cannot put the revoked token back for a whole TTL.
+    """
+
+    CHANNEL = "cardswood:auth-cache:revoke"
+
+    def __init__(self, ttl=300.0, negative_ttl=30.0, maxsize=10000, redis_url=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.redis_url = redis_url
+        self._cache = TTLCache(maxsize)
+        self._redis = None
+        self._listener = None
+        self.generation = 0
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "invalidations": 0, "remote_invalidations": 0, "stale_loads": 0}
+
+    async def get_user_id(self, token, loader):
+        """Cached user_id for ``token`` (None if unknown); ``loader(token)`` is awaited on a miss."""
+        user_id = self._cache.get(token)
+        if user_id is not _MISSING:
+            self._stats["hits" if user_id is not None else "negative_hits"] += 1
+            return user_id
+        self._stats["misses"] += 1
+        generation = self.generation
+        user_id = await loader(token)
+        self.remember(token, user_id, generation)
+        return user_id
+
+    def peek(self, token):
+        """(hit, user_id) without loading; lets callers fold a miss into a larger query."""
+        user_id = self._cache.get(token)
+        if user_id is _MISSING:
+            self._stats["misses"] += 1
+            return False, None
+        self._stats["hits" if user_id is not None else "negative_hits"] += 1
+        return True, user_id
+
+    def remember(self, token, user_id, generation=None):
+        """Caches a loaded value; pass the ``generation`` read before the load to drop a stale one."""
+        if generation is not None and generation != self.generation:
+            self._stats["stale_loads"] += 1
+            return
+        self._cache.set(token, user_id, self.ttl if user_id is not None else self.negative_ttl)
+
+    def _revoke(self, token):
+        self.generation += 1
+        self._cache.pop(token)
+
+    def clear(self):
+        self.generation += 1
+        self._cache.clear()
+
+    async def invalidate(self, token):
+        self._revoke(token)
+        self._stats["invalidations"] += 1
+        if self._redis is not None:
+            try:
+                await self._redis.publish(self.CHANNEL, token)
+            except Exception as e:
+                logging.warning(f"Auth cache: failed to publish revocation: {e}")
+
+    async def start(self):
+        """Connects the shared revocation channel (no-op without AUTH_CACHE_REDIS_URL)."""
+        if not self.redis_url or self._listener is not None:
+            return
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            logging.warning("Auth cache: AUTH_CACHE_REDIS_URL is set but the redis package is not installed")
+            return
+        self._redis = aioredis.from_url(self.redis_url)
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL)
+                    async for message in pubsub.listen():
+                        if message.get("type") != "message":
+                            continue
+                        token = message["data"]
+                        if isinstance(token, bytes):
+                            token = token.decode()
+                        self._revoke(token)
+                        self._stats["remote_invalidations"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Revocations published while disconnected are missed; drop everything to stay safe
+                logging.warning(f"Auth cache: revocation channel error, clearing cache: {e}")
+                self.clear()
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    def stats(self):
+        return dict(self._stats, size=len(self._cache), shared=self._redis is not None)
+
+
+class PermissionCache:
+    """username -> allowed flag for the ``allowed_user`` table (admin routes and /api/check_permission)."""
+
+    def __init__(self, ttl=60.0, maxsize=1024):
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize)
+        self._stats = {"hits": 0, "misses": 0}
+
+    def peek(self, username):
+        allowed = self._cache.get(username)
+        if allowed is _MISSING:
+            self._stats["misses"] += 1
+            return False, False
+        self._stats["hits"] += 1
+        return True, allowed
+
+    def remember(self, username, allowed):
+        self._cache.set(username, bool(allowed), self.ttl)
+
+    async def is_allowed(self, username, loader):
+        hit, allowed = self.peek(username)
+        if hit:
+            return allowed
+        allowed = bool(await loader(username))
+        self.remember(username, allowed)
+        return allowed
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return dict(self._stats, size=len(self._cache))
+
+
+token_cache = TokenCache(
+    ttl=Config.AUTH_CACHE_TTL,
+    negative_ttl=Config.AUTH_CACHE_NEGATIVE_TTL,
+    maxsize=Config.AUTH_CACHE_SIZE,
+    redis_url=Config.AUTH_CACHE_REDIS_URL,
+)
+
+permission_cache = PermissionCache(ttl=Config.ADMIN_CACHE_TTL, maxsize=Config.AUTH_CACHE_SIZE)
@@ -0,0 +1,249 @@
+"""Avatar proxy cache: content-addressed blobs on disk, hot tier in memory, one upstream fetch per URL at a time."""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from urllib.parse import urljoin, urlsplit
+
+from config import Config
+from http_clients import http_clients
+
+
+class AvatarTooLarge(Exception):
+    pass
+
+
+class AvatarFetchError(Exception):
+    pass
+
+
+def _parse_hosts(value):
+    return tuple(h.strip().lower().lstrip(".") for h in value.split(",") if h.strip())
+
+
+ALLOWED_HOSTS = _parse_hosts(Config.AVATAR_ALLOWED_HOSTS)
+
+
+def is_allowed_url(url):
+    """Only https URLs on the Telegram avatar hosts (or their subdomains) are proxied."""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    host = (parts.hostname or "").lower()
+    if parts.scheme != "https" or not host or parts.username or parts.password:
+        return False
+    return any(host == h or host.endswith("." + h) for h in ALLOWED_HOSTS)
+
+
+class Avatar:
+    __slots__ = ("digest", "content_type", "body", "fetched_at")
+
+    def __init__(self, digest, content_type, body, fetched_at):
+        self.digest = digest
+        self.content_type = content_type
+        self.body = body
+        self.fetched_at = fetched_at
+
+    @property
+    def etag(self):
+        return self.digest[:32]
+
+
+class AvatarCache:
+    """
+    url -> Avatar. Blobs live under ``blobs/<digest>`` (identical images share one file),
+    ``urls/<sha256(url)>.json`` points a URL at its blob. Disk is trimmed LRU by mtime
+    (touched on every hit) to ``disk_bytes``; the memory tier holds up to ``memory_bytes``.
+    Entries older than ``ttl`` are refetched; if the upstream then fails, the stale copy is served.
+    Only ``is_allowed_url`` URLs are fetched, redirects included, and only ``image/*`` bodies are kept.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, directory, ttl, max_object_bytes, memory_bytes, disk_bytes, max_redirects=3):
+        self.directory = directory
+        self.max_redirects = max_redirects
+        self.ttl = ttl
+        self.max_object_bytes = max_object_bytes
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = OrderedDict()  # url -> Avatar
+        self._memory_size = 0
+        self._disk_size = None
+        self._inflight = {}
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "fetches": 0, "coalesced": 0, "stale_served": 0, "too_large": 0, "evicted": 0, "rejected": 0}
+
+    def _url_key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _index_path(self, url):
+        return os.path.join(self.directory, "urls", self._url_key(url) + ".json")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, "blobs", digest)
+
+    async def get(self, url):
+        """Avatar for ``url``; raises AvatarFetchError / AvatarTooLarge when nothing usable is cached."""
+        if not is_allowed_url(url):
+            self._stats["rejected"] += 1
+            raise AvatarFetchError(f"Host not allowed: {url}")
+        avatar = self._memory_get(url)
+        if avatar is None:
+            avatar = await asyncio.to_thread(self._disk_get, url)
+            if avatar is not None:
+                self._stats["disk_hits"] += 1
+                self._memory_put(url, avatar)
+        else:
+            self._stats["memory_hits"] += 1
+        if avatar is not None and time.time() - avatar.fetched_at < self.ttl:
+            return avatar
+        try:
+            return await self._fetch_once(url)
+        except (AvatarFetchError, AvatarTooLarge):
+            if avatar is None:
+                raise
+            self._stats["stale_served"] += 1
+            return avatar
+
+    async def _fetch_once(self, url):
+        task = self._inflight.get(url)
+        if task is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(task)
+        task = asyncio.ensure_future(self._fetch(url))
+        self._inflight[url] = task
+        task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url):
+        self._stats["fetches"] += 1
+        chunks = []
+        size = 0
+        target = url
+        try:
+            # Redirects are followed by hand so every hop is checked against the allowed hosts
+            for _ in range(self.max_redirects + 1):
+                async with http_clients.telegram.stream("GET", target, follow_redirects=False) as r:
+                    if r.is_redirect:
+                        target = urljoin(target, r.headers.get("Location", ""))
+                        if not is_allowed_url(target):
+                            self._stats["rejected"] += 1
+                            raise AvatarFetchError(f"Redirect to a host that is not allowed: {target}")
+                        continue
+                    r.raise_for_status()
+                    content_type = r.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                    if not content_type.startswith("image/"):
+                        raise AvatarFetchError(f"Unexpected content type {content_type or 'none'}")
+                    declared = r.headers.get("Content-Length")
+                    if declared and declared.isdigit() and int(declared) > self.max_object_bytes:
+                        raise AvatarTooLarge(f"{declared} bytes")
+                    async for chunk in r.aiter_bytes(self.CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_object_bytes:
+                            raise AvatarTooLarge(f"more than {self.max_object_bytes} bytes")
+                        chunks.append(chunk)
+                    break
+            else:
+                raise AvatarFetchError(f"More than {self.max_redirects} redirects")
+        except AvatarTooLarge:
+            self._stats["too_large"] += 1
+            raise
+        except AvatarFetchError:
+            raise
+        except Exception as e:
+            raise AvatarFetchError(str(e)) from e
+        body = b"".join(chunks)
+        avatar = Avatar(hashlib.sha256(body).hexdigest(), content_type, body, time.time())
+        self._memory_put(url, avatar)
+        try:
+            await asyncio.to_thread(self._disk_put, url, avatar)
+        except OSError as e:
+            logging.warning(f"Avatar cache: could not persist {url}: {e}")
+        return avatar
+
+    def _memory_get(self, url):
+        avatar = self._memory.get(url)
+        if avatar is not None:
+            self._memory.move_to_end(url)
+        return avatar
+
+    def _memory_put(self, url, avatar):
+        old = self._memory.pop(url, None)
+        if old is not None:
+            self._memory_size -= len(old.body)
+        if len(avatar.body) > self.memory_bytes:
+            return
+        self._memory[url] = avatar
+        self._memory_size += len(avatar.body)
+        while self._memory_size > self.memory_bytes:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_size -= len(dropped.body)
+
+    def _disk_get(self, url):
+        try:
+            with open(self._index_path(url)) as f:
+                meta = json.load(f)
+            blob = self._blob_path(meta["digest"])
+            with open(blob, "rb") as f:
+                body = f.read()
+            os.utime(blob)
+        except (OSError, ValueError, KeyError):
+            return None
+        return Avatar(meta["digest"], meta["content_type"], body, meta["fetched_at"])
+
+    def _disk_put(self, url, avatar):
+        blob = self._blob_path(avatar.digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.makedirs(os.path.dirname(self._index_path(url)), exist_ok=True)
+        if not os.path.exists(blob):
+            tmp = f"{blob}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(avatar.body)
+            os.replace(tmp, blob)
+            if self._disk_size is not None:
+                self._disk_size += len(avatar.body)
+        index = self._index_path(url)
+        tmp = f"{index}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"digest": avatar.digest, "content_type": avatar.content_type, "fetched_at": avatar.fetched_at}, f)
+        os.replace(tmp, index)
+        self._trim_disk()
+
+    def _trim_disk(self):
+        blobs_dir = os.path.join(self.directory, "blobs")
+        if self._disk_size is not None and self._disk_size <= self.disk_bytes:
+            return
+        entries = []
+        for entry in os.scandir(blobs_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        self._disk_size = sum(e[1] for e in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if self._disk_size <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_size -= size
+            self._stats["evicted"] += 1
+        # Index files pointing at evicted blobs are dropped lazily by _disk_get
+
+    def stats(self):
+        return dict(self._stats, memory_entries=len(self._memory), memory_bytes=self._memory_size, disk_bytes=self._disk_size, inflight=len(self._inflight))
+
+
+avatar_cache = AvatarCache(
+    Config.AVATAR_CACHE_DIR,
+    ttl=Config.AVATAR_CACHE_TTL,
+    max_object_bytes=Config.AVATAR_MAX_BYTES,
+    memory_bytes=Config.AVATAR_CACHE_MEMORY_BYTES,
+    disk_bytes=Config.AVATAR_CACHE_DISK_BYTES,
+    max_redirects=Config.AVATAR_MAX_REDIRECTS,
+)
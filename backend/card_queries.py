@@ -0,0 +1,165 @@
+"""
+Whitelisted query plans for the card listing endpoint (bot's SQLite DB).
+
+/api/cards is the one catalog route that does not list from the in-memory snapshot
+(catalog.py): ordering, keyset pages and projection are done by SQLite on the pooled
+read connections, so a page costs a bounded, ordered scan of one season instead of
+copying and sorting the whole season in Python per request. The snapshot still
+supplies the season lookup and the ownership counts bound into the ``amount`` plan.
+"""
+import json
+import base64
+from functools import lru_cache
+
+from catalog import RARITY_ORDER
+
+SORT_DIRECTIONS = ("asc", "desc")
+MAX_PAGE_SIZE = 200
+
+# Rarity rank computed by SQLite, so rows stream out already ordered
+RARITY_RANK_SQL = "CASE rarity {} ELSE 0 END".format(
+    " ".join(f"WHEN '{name}' THEN {rank}" for name, rank in sorted(RARITY_ORDER.items(), key=lambda kv: kv[1]))
+)
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+class CardListPlan:
+    """
+    One sort key of /api/cards. ``select`` yields the plan's columns plus ``sort_key``;
+    pages are cut with a row-value keyset on ``(sort_key, id)``.
+    """
+
+    __slots__ = ("sort", "columns", "select")
+
+    def __init__(self, sort, columns, select):
+        self.sort = sort
+        self.columns = columns
+        self.select = select
+
+    def project(self, fields):
+        """Validated column tuple for a ``fields=`` value (``id`` is always included)."""
+        if not fields:
+            return self.columns
+        wanted = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = wanted.difference(self.columns)
+        if unknown:
+            raise InvalidQuery(f"Unknown fields: {', '.join(sorted(unknown))}")
+        wanted.add("id")
+        return tuple(c for c in self.columns if c in wanted)
+
+
+_BASE_COLUMNS = ("id", "uuid", "img", "name", "rarity", "points")
+
+
+def _base_select(sort_expr):
+    return (
+        "SELECT id, id AS uuid, photo AS img, name, rarity, points, "
+        f"{sort_expr} AS sort_key FROM cards WHERE season = ?"
+    )
+
+
+CARD_LIST_PLANS = {
+    "id": CardListPlan("id", _BASE_COLUMNS, _base_select("id")),
+    "name": CardListPlan("name", _BASE_COLUMNS, _base_select("COALESCE(name, '')")),
+    "points": CardListPlan("points", _BASE_COLUMNS, _base_select("COALESCE(points, 0)")),
+    "rarity": CardListPlan("rarity", ("id", "img", "name", "rarity", "points"), _base_select(RARITY_RANK_SQL)),
+    # Ownership counts come from the in-memory cache, bound as a JSON object {card_id: count}
+    "amount": CardListPlan(
+        "amount",
+        ("id", "img", "name", "rarity", "points", "amount"),
+        "SELECT c.id AS id, c.photo AS img, c.name AS name, c.rarity AS rarity, c.points AS points, "
+        "COALESCE(o.amount, 0) AS amount, COALESCE(o.amount, 0) AS sort_key "
+        "FROM cards c LEFT JOIN (SELECT CAST(key AS INTEGER) AS card_id, value AS amount FROM json_each(?)) o "
+        "ON o.card_id = c.id WHERE c.season = ?",
+    ),
+}
+
+
+@lru_cache(maxsize=256)
+def _statement(sort, direction, columns, after, limited):
+    plan = CARD_LIST_PLANS[sort]
+    op, order = (">", "ASC") if direction == "asc" else ("<", "DESC")
+    sql = f"SELECT {', '.join(columns)}, sort_key, id FROM ({plan.select})"
+    if after:
+        sql += f" WHERE (sort_key, id) {op} (?, ?)"
+    sql += f" ORDER BY sort_key {order}, id {order}"
+    if limited:
+        sql += " LIMIT ?"
+    return sql
+
+
+def encode_cursor(sort, direction, sort_key, card_id):
+    raw = json.dumps([sort, direction, sort_key, card_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sort, direction):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c_sort, c_direction, sort_key, card_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidQuery("Invalid cursor")
+    if (c_sort, c_direction) != (sort, direction) or not isinstance(card_id, int) or isinstance(card_id, bool):
+        raise InvalidQuery("Cursor does not match sort order")
+    if not isinstance(sort_key, (int, float, str)) or isinstance(sort_key, bool):
+        raise InvalidQuery("Invalid cursor")
+    return sort_key, card_id
+
+
+class CardListQuery:
+    """A planned /api/cards request: run ``sql`` with ``bind()``, shape rows with ``page()``."""
+
+    __slots__ = ("sort", "direction", "columns", "limit", "sql", "params", "season_id")
+
+    def __init__(self, season_id, sort="id", direction="asc", fields=None, limit=None, cursor=None):
+        plan = CARD_LIST_PLANS.get(sort)
+        direction = (direction or "").lower()
+        if plan is None or direction not in SORT_DIRECTIONS:
+            raise InvalidQuery("Invalid sort field or direction")
+        self.sort = sort
+        self.direction = direction
+        self.season_id = season_id
+        self.columns = plan.project(fields)
+        self.limit = None
+        if limit is not None:
+            try:
+                self.limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+            except (TypeError, ValueError):
+                raise InvalidQuery("Invalid limit")
+        params = [season_id]
+        after = None
+        if cursor:
+            after = decode_cursor(cursor, sort, direction)
+            params.extend(after)
+        if self.limit is not None:
+            params.append(self.limit)
+        self.sql = _statement(sort, direction, self.columns, after is not None, self.limit is not None)
+        self.params = tuple(params)
+
+    @property
+    def needs_counts(self):
+        return self.sort == "amount"
+
+    def bind(self, counts=None):
+        """Statement parameters; ``counts`` (card_id -> owned) is required for ``needs_counts`` plans."""
+        if self.needs_counts:
+            return (json.dumps(counts or {}, separators=(",", ":")),) + self.params
+        return self.params
+
+    @property
+    def paginated(self):
+        return self.limit is not None
+
+    def page(self, rows):
+        """Returns (cards, next_cursor) for the fetched rows."""
+        n = len(self.columns)
+        columns = self.columns
+        cards = [dict(zip(columns, row[:n])) for row in rows]
+        next_cursor = None
+        if self.limit is not None and len(rows) == self.limit:
+            last = rows[-1]
+            next_cursor = encode_cursor(self.sort, self.direction, last[n], last[n + 1])
+        return cards, next_cursor
@@ -0,0 +1,133 @@
+"""In-process snapshot of the bot's ``cards`` table with change detection."""
+import time
+import asyncio
+import hashlib
+import logging
+from collections import namedtuple
+
+from config import Config
+from async_db import sqlite_pool
+
+CARD_COLUMNS = ("id", "photo", "name", "rarity", "points", "number", "drop", "event", "season")
+CardRow = namedtuple("CardRow", CARD_COLUMNS)
+
+_SELECT_CARDS = "SELECT id, photo, name, rarity, points, number, [drop], event, season FROM cards"
+
+RARITY_ORDER = {
+    "EPISODICAL": 1, "SECONDARY": 2, "FAMOUS": 3, "MAINCHARACTER": 4,
+    "MOVIE": 5, "SERIES": 6, "ACHIEVEMENTS": 7,
+}
+
+
+class CatalogSnapshot:
+    """Immutable view of ``cards``: rows by id, ids grouped by season and by rarity."""
+
+    __slots__ = (
+        "generation", "count", "max_rowid", "loaded_at", "digest",
+        "cards_by_id", "by_season", "by_rarity", "seasons",
+    )
+
+    def __init__(self, generation, count, max_rowid, rows, loaded_at=None):
+        self.generation = generation
+        self.count = count
+        self.max_rowid = max_rowid
+        self.loaded_at = time.monotonic() if loaded_at is None else loaded_at
+        self.cards_by_id = {row.id: row for row in rows}
+        by_season = {}
+        by_rarity = {}
+        for row in sorted(self.cards_by_id.values(), key=lambda r: r.id):
+            if row.season is not None:
+                by_season.setdefault(row.season, []).append(row.id)
+            by_rarity.setdefault(row.rarity, []).append(row.id)
+        self.by_season = {k: tuple(v) for k, v in by_season.items()}
+        self.by_rarity = {k: tuple(v) for k, v in by_rarity.items()}
+        self.seasons = sorted(self.by_season)
+        # Content hash, identical across workers/restarts for identical data (used for ETags)
+        self.digest = hashlib.blake2b(
+            repr(sorted(self.cards_by_id.items())).encode(), digest_size=16
+        ).hexdigest()
+
+    @property
+    def version(self):
+        return f"{self.generation}.{self.max_rowid}"
+
+    def season_cards(self, season):
+        cards_by_id = self.cards_by_id
+        return [cards_by_id[cid] for cid in self.by_season.get(season, ())]
+
+
+class Catalog:
+    """
+    Keeps a CatalogSnapshot in sync with the bot DB.
+
+    A refresh is only considered when the pool saw a commit (``data_version``)
+    or the DB/WAL file mtime moved. Filmstrip-only writes are filtered out by
+    comparing ``count(*)``/``max(rowid)`` of ``cards``; appended cards are loaded
+    incrementally, anything else triggers a full reload. A full reload also
+    happens every ``max_age`` seconds to pick up in-place edits.
+    """
+
+    def __init__(self, pool, max_age=300.0):
+        self.pool = pool
+        self.max_age = max_age
+        self._snapshot = None
+        self._seen = None
+        self._lock = None
+        self._stats = {"checks": 0, "full_loads": 0, "incremental_loads": 0}
+
+    async def get(self):
+        snap = self._snapshot
+        if snap is not None and self._seen == self.pool.signature() and time.monotonic() - snap.loaded_at < self.max_age:
+            return snap
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await self._refresh()
+
+    async def _refresh(self):
+        signature = self.pool.signature()
+        snap = self._snapshot
+        expired = snap is None or time.monotonic() - snap.loaded_at >= self.max_age
+        if not expired and signature == self._seen:
+            return snap
+        self._stats["checks"] += 1
+        async with self.pool.connection() as conn:
+            async with conn.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM cards") as cur:
+                count, max_rowid = await cur.fetchone()
+            if expired:
+                snap = await self._load_full(conn, count, max_rowid)
+            elif (count, max_rowid) != (snap.count, snap.max_rowid):
+                snap = await self._load_incremental(conn, snap, count, max_rowid)
+        self._snapshot = snap
+        self._seen = signature
+        return snap
+
+    async def _load_full(self, conn, count, max_rowid):
+        async with conn.execute(_SELECT_CARDS) as cur:
+            rows = [CardRow(*r) for r in await cur.fetchall()]
+        self._stats["full_loads"] += 1
+        generation = self._snapshot.generation + 1 if self._snapshot else 1
+        logging.info(f"Catalog: loaded {len(rows)} cards (generation {generation})")
+        return CatalogSnapshot(generation, count, max_rowid, rows)
+
+    async def _load_incremental(self, conn, snap, count, max_rowid):
+        async with conn.execute(_SELECT_CARDS + " WHERE rowid > ?", (snap.max_rowid,)) as cur:
+            new_rows = [CardRow(*r) for r in await cur.fetchall()]
+        if snap.count + len(new_rows) != count:
+            # Rows were deleted or rewritten, an append-only delta is not enough
+            return await self._load_full(conn, count, max_rowid)
+        self._stats["incremental_loads"] += 1
+        logging.info(f"Catalog: appended {len(new_rows)} cards (generation {snap.generation + 1})")
+        rows = list(snap.cards_by_id.values()) + new_rows
+        return CatalogSnapshot(snap.generation + 1, count, max_rowid, rows, loaded_at=snap.loaded_at)
+
+    def stats(self):
+        snap = self._snapshot
+        return dict(
+            self._stats,
+            version=snap.version if snap else None,
+            cards=snap.count if snap else 0,
+        )
+
+
+catalog = Catalog(sqlite_pool, max_age=Config.CATALOG_MAX_AGE)
@@ -0,0 +1,42 @@
+"""Card comments read path: keyset pages as plain rows, per-card counts."""
+from sqlalchemy import select, func
+
+from models import Comment
+
+MAX_PAGE_SIZE = 200
+MAX_COUNT_CARDS = 500
+
+_COLUMNS = (Comment.id, Comment.uuid, Comment.user_id, Comment.text, Comment.card_id)
+_KEYS = tuple(c.key for c in _COLUMNS)
+
+
+async def fetch_comments(db_session, card_id, limit=None, after=None):
+    """
+    Comments of one card in id order, starting after comment id ``after``.
+    Returns (comments, next_cursor); next_cursor is None on the last page or without ``limit``.
+    """
+    stmt = select(*_COLUMNS).where(Comment.card_id == card_id)
+    if after is not None:
+        stmt = stmt.where(Comment.id > after)
+    stmt = stmt.order_by(Comment.id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    r = await db_session.execute(stmt)
+    comments = [dict(zip(_KEYS, row)) for row in r]
+    next_cursor = None
+    if limit is not None and len(comments) == limit:
+        next_cursor = str(comments[-1]["id"])
+    return comments, next_cursor
+
+
+async def comment_counts(db_session, card_ids):
+    """card_id -> number of comments, 0 for cards without any."""
+    card_ids = list(dict.fromkeys(card_ids))
+    if not card_ids:
+        return {}
+    r = await db_session.execute(
+        select(Comment.card_id, func.count()).where(Comment.card_id.in_(card_ids)).group_by(Comment.card_id)
+    )
+    counts = dict.fromkeys(card_ids, 0)
+    counts.update(r.all())
+    return counts
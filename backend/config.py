@@ -23,12 +23,83 @@ class Config:
     SQLALCHEMY_DATABASE_URI = _pg_uri
     ASYNC_DATABASE_URI = _pg_uri.replace("postgresql+psycopg2://", "postgresql+asyncpg://", 1)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Async engine (asyncpg): persistent / extra connections, seconds to wait for one, max connection age (s),
+    # ping on checkout; prepared statements cached per connection (0 behind pgbouncer in transaction mode);
+    # entries in SQLAlchemy's compiled-statement cache
+    PG_POOL_SIZE = int(os.getenv("PG_POOL_SIZE", "5"))
+    PG_MAX_OVERFLOW = int(os.getenv("PG_MAX_OVERFLOW", "10"))
+    PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "30"))
+    PG_POOL_RECYCLE = int(os.getenv("PG_POOL_RECYCLE", "1800"))
+    PG_POOL_PRE_PING = os.getenv("PG_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+    PG_QUERY_CACHE_SIZE = int(os.getenv("PG_QUERY_CACHE_SIZE", "500"))
     SECRET_KEY = os.getenv("SECRET_KEY")
 
 
     # For SQLite over TCP proxy
     SQLITE_DB_PATH = "/app/db/offcardswood.db"  # Mounted path in container
     # SQLALCHEMY_BINDS = f"sqlite:///{SQLITE_DB_PATH}?mode=ro"  # Read-only mode
+    # Pool of warm read-only connections to the bot DB
+    SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+    SQLITE_POOL_TIMEOUT = float(os.getenv("SQLITE_POOL_TIMEOUT", "10"))
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+    SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-16000"))  # negative = KiB
+    # Writes to the bot DB (grants): busy_timeout per statement, then whole-transaction retries with jittered backoff
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_WRITE_RETRIES = int(os.getenv("SQLITE_WRITE_RETRIES", "5"))
+    SQLITE_WRITE_BACKOFF = float(os.getenv("SQLITE_WRITE_BACKOFF", "0.05"))
+    SQLITE_WRITE_BACKOFF_MAX = float(os.getenv("SQLITE_WRITE_BACKOFF_MAX", "2"))
+    # In-memory cards catalog: forced full reload interval (seconds)
+    CATALOG_MAX_AGE = float(os.getenv("CATALOG_MAX_AGE", "300"))
+    # Per-card ownership counts: full filmstrips rescan interval (seconds), catches rows deleted by the bot
+    OWNERSHIP_RESCAN_INTERVAL = float(os.getenv("OWNERSHIP_RESCAN_INTERVAL", "300"))
+
+    # auth_token lookups: positive/negative TTL (seconds), max entries, optional Redis for cross-worker revocation
+    AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+    AUTH_CACHE_NEGATIVE_TTL = float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", "30"))
+    AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+    AUTH_CACHE_REDIS_URL = os.getenv("AUTH_CACHE_REDIS_URL", "").strip() or None
+    # allowed_user (admin) flags per username; edits to allowed_user take effect after this many seconds
+    ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "60"))
+
+    # Outbound HTTP (Telegram CDN, purchase_notify): pool limits per client, keep-alive, HTTP/2 when h2 is installed
+    HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+    HTTP_POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+    HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+    HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+
+    # Who sends static images: "app" (streamed by the worker), "x-accel" (nginx X-Accel-Redirect to
+    # STATIC_ACCEL_PREFIX/<card_imgs|card_img_cache|avatars|public>/<file>) or "x-sendfile" (absolute path)
+    STATIC_DELIVERY = os.getenv("STATIC_DELIVERY", "app").strip().lower()
+    STATIC_ACCEL_PREFIX = os.getenv("STATIC_ACCEL_PREFIX", "/_static")
+
+    # Card image uploads (add_card / update_card_image): max image size in bytes
+    CARD_IMAGE_MAX_BYTES = int(os.getenv("CARD_IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+    # Card image variants (/card_imgs/<file>?w=&fmt=): allowed widths, format when only w is given,
+    # cache directory and budget (bytes), render processes, encoder quality, variants rendered on upload
+    CARD_IMAGE_WIDTHS = os.getenv("CARD_IMAGE_WIDTHS", "128,256,512,1024")
+    CARD_IMAGE_DEFAULT_FORMAT = os.getenv("CARD_IMAGE_DEFAULT_FORMAT", "webp")
+    CARD_IMAGE_CACHE_DIR = os.getenv("CARD_IMAGE_CACHE_DIR", "card_img_cache")
+    CARD_IMAGE_CACHE_DISK_BYTES = int(os.getenv("CARD_IMAGE_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+    CARD_IMAGE_WORKERS = int(os.getenv("CARD_IMAGE_WORKERS", "2"))
+    CARD_IMAGE_QUALITY = int(os.getenv("CARD_IMAGE_QUALITY", "80"))
+    CARD_IMAGE_PREGENERATE = os.getenv("CARD_IMAGE_PREGENERATE", "256:webp,512:webp")
+
+    # /proxy/avatar cache: refetch after TTL (seconds), per-image cap, memory and disk budgets (bytes)
+    AVATAR_CACHE_DIR = os.getenv("AVATAR_CACHE_DIR", "avatar_cache")
+    AVATAR_CACHE_TTL = float(os.getenv("AVATAR_CACHE_TTL", "86400"))
+    AVATAR_MAX_BYTES = int(os.getenv("AVATAR_MAX_BYTES", str(2 * 1024 * 1024)))
+    AVATAR_CACHE_MEMORY_BYTES = int(os.getenv("AVATAR_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+    AVATAR_CACHE_DISK_BYTES = int(os.getenv("AVATAR_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+    # Hosts /proxy/avatar may fetch from (and be redirected to); subdomains included
+    AVATAR_ALLOWED_HOSTS = os.getenv("AVATAR_ALLOWED_HOSTS", "t.me,telegram.org,telesco.pe,cdn-telegram.org")
+    AVATAR_MAX_REDIRECTS = int(os.getenv("AVATAR_MAX_REDIRECTS", "3"))
+
+    # Cache-Control per route family (catalog JSON carries an ETag, so revalidate by default)
+    CACHE_CONTROL_CATALOG = os.getenv("CACHE_CONTROL_CATALOG", "public, no-cache")
+    CACHE_CONTROL_STATIC = os.getenv("CACHE_CONTROL_STATIC", "public, max-age=86400")
+    # Encoded catalog JSON bodies kept per ETag (catalog version + URL), total bytes
+    CATALOG_RESPONSE_CACHE_BYTES = int(os.getenv("CATALOG_RESPONSE_CACHE_BYTES", str(16 * 1024 * 1024)))
 
     # PayAnyWay payment integration (from env; optional for local dev)
     PAYANYWAY_MNT_ID = os.getenv("PAYANYWAY_MNT_ID", "")
@@ -45,8 +116,44 @@ class Config:
     PAYANYWAY_FAIL_URL = os.getenv("PAYANYWAY_FAIL_URL", f"{_base}/shop/fail")
     # Optional: Check URL (callback) — if set, sent in form; otherwise configure in PayAnyWay LK
     PAYANYWAY_CHECK_URL = os.getenv("PAYANYWAY_CHECK_URL", "").strip() or None
+    # Upper bound for item quantity in one order line (create_order refuses more, grants skip it)
+    ORDER_MAX_QUANTITY = int(os.getenv("ORDER_MAX_QUANTITY", "10"))
+
+    # Order fulfillment workers (grant + bot notification after payment): claim loops per process,
+    # idle poll interval and job lease (seconds), attempts before a job is marked failed, first retry delay
+    FULFILLMENT_CONCURRENCY = int(os.getenv("FULFILLMENT_CONCURRENCY", "2"))
+    FULFILLMENT_POLL_INTERVAL = float(os.getenv("FULFILLMENT_POLL_INTERVAL", "5"))
+    FULFILLMENT_LEASE = float(os.getenv("FULFILLMENT_LEASE", "120"))
+    FULFILLMENT_MAX_ATTEMPTS = int(os.getenv("FULFILLMENT_MAX_ATTEMPTS", "8"))
+    FULFILLMENT_RETRY_BASE = float(os.getenv("FULFILLMENT_RETRY_BASE", "10"))
+    # Reconciliation sweeper (reconcile.py): seconds between sweeps (0 = no in-process sweeper, run
+    # `python reconcile.py` from cron instead), rows per step per sweep, pending orders older than
+    # PENDING_ORDER_TTL are expired, failed jobs/notifications are re-driven after RECONCILE_REDRIVE_AFTER,
+    # paid orders without a job are looked for within RECONCILE_LOOKBACK (all in seconds)
+    RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "300"))
+    RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+    PENDING_ORDER_TTL = float(os.getenv("PENDING_ORDER_TTL", str(24 * 3600)))
+    RECONCILE_REDRIVE_AFTER = float(os.getenv("RECONCILE_REDRIVE_AFTER", str(6 * 3600)))
+    # Automatic re-drives per failed job / notification before it is left for an operator
+    RECONCILE_MAX_REDRIVES = int(os.getenv("RECONCILE_MAX_REDRIVES", "3"))
+    RECONCILE_PAID_GRACE = float(os.getenv("RECONCILE_PAID_GRACE", "300"))
+    RECONCILE_LOOKBACK = float(os.getenv("RECONCILE_LOOKBACK", str(7 * 24 * 3600)))
 
     # URL for notifying the game bot when a purchase is completed (for granting items)
     BOT_PURCHASE_NOTIFY_URL = os.getenv("BOT_PURCHASE_NOTIFY_URL", "").strip() or None
+    # Bulk endpoint the notification outbox drains to (default: <BOT_PURCHASE_NOTIFY_URL>/bulk)
+    BOT_PURCHASE_NOTIFY_BULK_URL = os.getenv("BOT_PURCHASE_NOTIFY_BULK_URL", "").strip() or (
+        BOT_PURCHASE_NOTIFY_URL.rstrip("/") + "/bulk" if BOT_PURCHASE_NOTIFY_URL else None
+    )
+    # Outbox sender: messages per bulk POST, idle poll interval (seconds), attempts before a message is marked failed
+    NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "50"))
+    NOTIFY_POLL_INTERVAL = float(os.getenv("NOTIFY_POLL_INTERVAL", "2"))
+    NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "10"))
+    # Delivery status of messages purchase_notify accepted (default: next to the bulk URL), polled every
+    # NOTIFY_STATUS_INTERVAL seconds per message
+    BOT_PURCHASE_NOTIFY_STATUS_URL = os.getenv("BOT_PURCHASE_NOTIFY_STATUS_URL", "").strip() or (
+        BOT_PURCHASE_NOTIFY_BULK_URL.rstrip("/").rsplit("/", 1)[0] + "/status" if BOT_PURCHASE_NOTIFY_BULK_URL else None
+    )
+    NOTIFY_STATUS_INTERVAL = float(os.getenv("NOTIFY_STATUS_INTERVAL", "60"))
     # Optional: secret for authenticating purchase webhook (set Authorization: Bearer <secret>)
     BOT_PURCHASE_WEBHOOK_SECRET = os.getenv("BOT_PURCHASE_WEBHOOK_SECRET", "").strip() or None
\ No newline at end of file
@@ -0,0 +1,339 @@
+"""
+Order fulfillment pipeline: the payment callback marks the order paid and enqueues a
+FulfillmentJob in one statement (``mark_order_paid``); workers grant the items and queue
+the bot notification in the outbox (notify_outbox.py) outside the request.
+
+Workers claim due jobs with ``FOR UPDATE SKIP LOCKED`` and hold them under a lease
+(``locked_until``), so several app processes can run workers side by side and a job left
+``running`` by a crashed or restarted process is picked up again once its lease expires.
+The lease is renewed while the worker is still on the job, so a slow step does not let
+another worker claim it. Each step is recorded on the job (``granted``, ``notified``) as soon
+as it succeeds, so a retry resumes where the previous attempt stopped.
+
+The grant writes to the bot's SQLite DB, so it cannot share a transaction with the job. It is
+applied at most once: ``grant_started_at`` is set (conditionally, so only one attempt wins)
+before the write and cleared only when the write rolled back. A job found with the flag set
+and ``granted`` false, after a crash or a lost mark, is failed for manual review, not regranted.
+"""
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, update, insert, literal, exists, true, false, or_
+
+from config import Config
+from models import Order, FulfillmentJob
+from async_db import get_async_session
+from grants import grant_order
+from http_clients import http_clients
+from notify_outbox import purchase_payload, enqueue_notification, outbox_sender
+
+OPEN_STATUSES = ("pending", "running")
+# Orders a payment callback may move to "paid": a late callback for an order the reconciler
+# expired is still a real payment
+PAYABLE_STATUSES = ("pending", "expired")
+
+
+async def notify_bot_purchase(order, max_retries=3):
+    """
+    Notify purchase_notify service about completed order with a single webhook
+    (used by the dev test-grant endpoint; paid orders go through the outbox).
+    Retries up to max_retries times with exponential backoff.
+    Returns (notification_status, notification_error) for persistence.
+    """
+    url = getattr(Config, "BOT_PURCHASE_NOTIFY_URL", None)
+    if not url:
+        logging.info(f"Order {order.order_number}: BOT_PURCHASE_NOTIFY_URL not set, skipping notification")
+        return "skipped", None
+
+    payload = purchase_payload(order)
+    headers = {}
+    if getattr(Config, "BOT_PURCHASE_WEBHOOK_SECRET", None):
+        headers["Authorization"] = f"Bearer {Config.BOT_PURCHASE_WEBHOOK_SECRET}"
+    last_error = None
+
+    for attempt in range(1, max_retries + 1):
+        try:
+            r = await http_clients.notify.post(url, json=payload, headers=headers)
+            if r.status_code < 400:
+                logging.info(f"Order {order.order_number}: Notification sent successfully (attempt {attempt})")
+                return "sent", None
+            else:
+                last_error = f"HTTP {r.status_code}: {r.text[:200]}"
+                logging.warning(f"Order {order.order_number}: Notification failed (attempt {attempt}/{max_retries}): {last_error}")
+        except httpx.HTTPError as e:
+            last_error = str(e)
+            logging.warning(f"Order {order.order_number}: Notification failed (attempt {attempt}/{max_retries}): {last_error}")
+        except Exception as e:
+            last_error = str(e)
+            logging.exception(f"Order {order.order_number}: Unexpected error during notification (attempt {attempt}/{max_retries}): {e}")
+        
+        if attempt < max_retries:
+            wait_time = 2 ** attempt  # Exponential backoff: 2s, 4s, 8s
+            logging.info(f"Order {order.order_number}: Retrying notification in {wait_time}s...")
+            await asyncio.sleep(wait_time)
+    
+    # All retries failed
+    error_msg = (last_error or "unknown")[:512]
+    logging.error(
+        f"Order {order.order_number} (user_id={order.user_id}, amount={order.amount} {order.currency}): "
+        f"Failed to send notification after {max_retries} attempts. Last error: {last_error}. "
+        f"Order is marked as PAID but user may not have received Telegram notification. "
+        f"Manual intervention may be required to grant items or notify user."
+    )
+    return "failed", error_msg
+
+
+
+async def mark_order_paid(db_session, order_number, payment_id):
+    """
+    Moves a pending (or expired) order to "paid" and enqueues its fulfillment job in one statement.
+
+    ``UPDATE ... WHERE status IN ('pending', 'expired') RETURNING`` is the only transition, so of any number
+    of concurrent deliveries for one order exactly one gets ``transitioned=True``; a late one
+    blocks on the row lock, re-checks the condition and matches nothing. Returns the order row
+    (id, order_number, user_id, amount, currency, transitioned), or None if the order is unknown.
+    """
+    now = datetime.utcnow()
+    paid = (
+        update(Order)
+        .where(Order.order_number == order_number, Order.status.in_(PAYABLE_STATUSES))
+        .values(status="paid", payanyway_payment_id=payment_id, updated_at=now)
+        .returning(Order.id, Order.order_number, Order.user_id, Order.amount, Order.currency)
+        .cte("paid")
+    )
+    job = (
+        insert(FulfillmentJob)
+        .from_select(
+            ["order_id", "status", "granted", "notified", "attempts", "run_after", "created_at", "updated_at"],
+            select(paid.c.id, literal("pending"), false(), false(), literal(0), literal(now), literal(now), literal(now)),
+        )
+        .returning(FulfillmentJob.order_id)
+        .cte("job")
+    )
+    transitioned = select(
+        paid.c.id, paid.c.order_number, paid.c.user_id, paid.c.amount, paid.c.currency, true().label("transitioned")
+    ).join_from(paid, job, job.c.order_id == paid.c.id)
+    # Duplicate delivery: the UPDATE matched nothing, report the existing row
+    existing = select(
+        Order.id, Order.order_number, Order.user_id, Order.amount, Order.currency, false().label("transitioned")
+    ).where(Order.order_number == order_number, ~exists(select(paid.c.id)))
+    r = await db_session.execute(transitioned.union_all(existing))
+    return r.first()
+
+
+class GrantOutcomeUnknown(Exception):
+    """An earlier attempt started the bot DB write and never recorded how it ended."""
+
+
+class FulfillmentWorker:
+    """``concurrency`` claim loops per process; ``wake()`` skips the poll delay after an enqueue."""
+
+    def __init__(self, concurrency=2, poll_interval=5.0, lease=120.0, max_attempts=8, retry_base=10.0, retry_max=600.0):
+        self.concurrency = max(1, int(concurrency))
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._tasks = []
+        self._wakeup = None
+        self._stats = {"claimed": 0, "done": 0, "retried": 0, "failed": 0}
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._loop(i)) for i in range(self.concurrency)]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        # A job interrupted here keeps its lease and is resumed after it expires
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self, n):
+        while True:
+            try:
+                job_id = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Fulfillment worker {n}: claim failed: {e}")
+                job_id = None
+            if job_id is not None:
+                try:
+                    await self._run(job_id)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # The lease expires and the job is claimed again
+                    logging.warning(f"Fulfillment worker {n}: job id={job_id} failed: {e}")
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self):
+        now = datetime.utcnow()
+        async with get_async_session() as db_session:
+            r = await db_session.execute(
+                select(FulfillmentJob)
+                .where(
+                    FulfillmentJob.status.in_(OPEN_STATUSES),
+                    FulfillmentJob.run_after <= now,
+                    or_(FulfillmentJob.locked_until.is_(None), FulfillmentJob.locked_until < now),
+                )
+                .order_by(FulfillmentJob.run_after)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            job = r.scalar_one_or_none()
+            if job is None:
+                return None
+            job.status = "running"
+            job.attempts += 1
+            job.locked_until = now + timedelta(seconds=self.lease)
+            self._stats["claimed"] += 1
+            return job.id
+
+    async def _run(self, job_id):
+        async with get_async_session() as db_session:
+            job = await db_session.get(FulfillmentJob, job_id)
+            order = await db_session.get(Order, job.order_id) if job is not None else None
+        if job is None or order is None:
+            logging.warning(f"Fulfillment: job id={job_id} or its order no longer exists, skipping")
+            return
+        heartbeat = asyncio.ensure_future(self._renew_lease(job_id))
+        try:
+            await self._steps(job, order)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _steps(self, job, order):
+        job_id = job.id
+        try:
+            if not job.granted:
+                await self._grant_once(job_id, order)
+            if not job.notified:
+                await self._notify(order)
+                await self._mark(job_id, notified=True)
+        except GrantOutcomeUnknown as e:
+            await self._retry_or_fail(job, order, e, retry=False)
+            return
+        except Exception as e:
+            await self._retry_or_fail(job, order, e)
+            return
+        await self._mark(job_id, status="done", locked_until=None, last_error=None)
+        self._stats["done"] += 1
+        logging.info("Fulfillment: order %s done (attempt %s)", order.order_number, job.attempts)
+
+    async def _grant_once(self, job_id, order):
+        async with get_async_session() as db_session:
+            r = await db_session.execute(
+                update(FulfillmentJob)
+                .where(FulfillmentJob.id == job_id, FulfillmentJob.grant_started_at.is_(None), FulfillmentJob.granted.is_(False))
+                .values(grant_started_at=datetime.utcnow())
+                .returning(FulfillmentJob.id)
+            )
+            started = r.first() is not None
+        if not started:
+            raise GrantOutcomeUnknown(
+                "an earlier attempt started the grant and did not record its outcome; check the bot DB, "
+                "then set granted=true (items present) or clear grant_started_at (not present) and re-run the job"
+            )
+        try:
+            await self._grant(order)
+        except Exception:
+            # grant_order raises only when the SQLite transaction rolled back, so a retry is safe
+            await self._mark(job_id, grant_started_at=None)
+            raise
+        await self._mark(job_id, granted=True)
+
+    async def _grant(self, order):
+        if not order.user_id:
+            logging.warning("Grant: order %s has no user_id, skipping", order.order_number)
+            return
+        logging.info("Grant: starting grant for order %s, tg_id=%s, items=%r", order.order_number, order.user_id, order.items)
+        await grant_order(order)
+
+    async def _notify(self, order):
+        # Delivery (batching, rate limits, acks) is the outbox sender's job; this step only records it
+        if not Config.BOT_PURCHASE_NOTIFY_BULK_URL:
+            logging.info(f"Order {order.order_number}: BOT_PURCHASE_NOTIFY_BULK_URL not set, skipping notification")
+            status = "skipped"
+        else:
+            status = "queued"
+        async with get_async_session() as db_session:
+            if status == "queued":
+                await enqueue_notification(db_session, order)
+            await db_session.execute(update(Order).where(Order.id == order.id).values(notification_status=status))
+        if status == "queued":
+            outbox_sender.wake()
+
+    async def _renew_lease(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with get_async_session() as db_session:
+                    await db_session.execute(
+                        update(FulfillmentJob)
+                        .where(FulfillmentJob.id == job_id, FulfillmentJob.status == "running")
+                        .values(locked_until=datetime.utcnow() + timedelta(seconds=self.lease))
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Fulfillment: renewing the lease of job id={job_id} failed: {e}")
+
+    async def _mark(self, job_id, **values):
+        async with get_async_session() as db_session:
+            job = await db_session.get(FulfillmentJob, job_id)
+            for k, v in values.items():
+                setattr(job, k, v)
+
+    async def _retry_or_fail(self, job, order, error, retry=True):
+        message = str(error)[:512]
+        if not retry or job.attempts >= self.max_attempts:
+            self._stats["failed"] += 1
+            logging.error(
+                f"Order {order.order_number} (user_id={order.user_id}, amount={order.amount} {order.currency}): "
+                f"fulfillment failed after {job.attempts} attempts. Last error: {message}. "
+                f"Order is marked as PAID; manual intervention may be required to grant items or notify user."
+            )
+            await self._mark(job.id, status="failed", locked_until=None, last_error=message)
+            return
+        delay = min(self.retry_max, self.retry_base * 2 ** (job.attempts - 1)) * random.uniform(0.8, 1.2)
+        self._stats["retried"] += 1
+        logging.warning(
+            "Fulfillment: order %s attempt %s failed (%s), retrying in %.0fs", order.order_number, job.attempts, message, delay
+        )
+        await self._mark(
+            job.id,
+            status="pending",
+            locked_until=None,
+            last_error=message,
+            run_after=datetime.utcnow() + timedelta(seconds=delay),
+        )
+
+    def stats(self):
+        return dict(self._stats, workers=len(self._tasks))
+
+
+fulfillment_worker = FulfillmentWorker(
+    concurrency=Config.FULFILLMENT_CONCURRENCY,
+    poll_interval=Config.FULFILLMENT_POLL_INTERVAL,
+    lease=Config.FULFILLMENT_LEASE,
+    max_attempts=Config.FULFILLMENT_MAX_ATTEMPTS,
+    retry_base=Config.FULFILLMENT_RETRY_BASE,
+)
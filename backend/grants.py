@@ -0,0 +1,179 @@
+"""
+Shop product grants for the bot's SQLite DB.
+
+PRODUCTS maps a shop product id (item.id from Shop.vue) to grant actions. An order is
+first planned outside any transaction (packs drawn, card names resolved from the catalog),
+merged per user, then applied by the SQLite writer in a single ``BEGIN IMMEDIATE``
+transaction: one ``users`` UPDATE per user and one ``executemany`` into ``filmstrips``.
+"""
+import time
+import logging
+from collections import namedtuple
+
+from config import Config
+from catalog import catalog
+from ownership import ownership
+from sampler import card_sampler
+from sqlite_writer import sqlite_writer
+
+# Grant actions
+GiveCard = namedtuple("GiveCard", ("card_id",))
+GiveCardByName = namedtuple("GiveCardByName", ("name", "fallback_id"))
+GivePack = namedtuple("GivePack", ("pack_type",))
+AddShoppoints = namedtuple("AddShoppoints", ("amount",))
+StartSubscription = namedtuple("StartSubscription", ())
+
+PRODUCTS = {
+    7: (GiveCard(1),),                                         # тестовый товар
+    1: (StartSubscription(),),                                 # подписка
+    2: (StartSubscription(), AddShoppoints(50000)),            # премиум-подписка
+    3: (GivePack("regular"),),
+    4: (GivePack("rare"),),
+    6: (GivePack("epic"),),
+    5: (GiveCardByName("HOME ALONE", 1),),
+    8: (AddShoppoints(100000),),                               # карьера: учёба
+    9: (AddShoppoints(200000),),                               # карьера: бизнес
+}
+
+
+class GrantPlan:
+    """Everything one user receives, merged across all actions of one or more orders."""
+
+    __slots__ = ("tg_id", "card_ids", "shoppoints", "subscription")
+
+    def __init__(self, tg_id):
+        self.tg_id = tg_id
+        self.card_ids = []
+        self.shoppoints = 0
+        self.subscription = False
+
+    def __bool__(self):
+        return bool(self.card_ids or self.shoppoints or self.subscription)
+
+    def __repr__(self):
+        return f"<GrantPlan tg_id={self.tg_id} cards={self.card_ids} shoppoints=+{self.shoppoints} subscription={self.subscription}>"
+
+
+def _find_card_by_name(snap, name):
+    needle = name.upper()
+    for card_id in sorted(snap.cards_by_id):
+        card_name = snap.cards_by_id[card_id].name
+        if card_name and needle in card_name.upper():
+            return card_id
+    return None
+
+
+def line_quantity(item, max_quantity=None):
+    """Quantity of an order line as an int in 1..ORDER_MAX_QUANTITY (absent means 1), else None."""
+    max_quantity = Config.ORDER_MAX_QUANTITY if max_quantity is None else max_quantity
+    quantity = item.get("quantity", 1)
+    if isinstance(quantity, bool) or not isinstance(quantity, int):
+        return None
+    return quantity if 1 <= quantity <= max_quantity else None
+
+
+async def plan_items(plan, items, order_number=None, sampler=card_sampler):
+    """Adds the actions for ``items`` (order.items) to ``plan``; unknown products are logged and skipped."""
+    for it in items or ():
+        pid = it.get("id")
+        if pid is None:
+            continue
+        try:
+            actions = PRODUCTS.get(int(pid))
+        except (TypeError, ValueError):
+            logging.warning("Grant: invalid product id %r in order %s", pid, order_number)
+            continue
+        quantity = line_quantity(it)
+        if quantity is None:
+            logging.warning("Grant: invalid quantity %r for product %s in order %s, skipping", it.get("quantity"), pid, order_number)
+            continue
+        if actions is None:
+            logging.info("Grant: unknown product id %s in order %s, skipping", pid, order_number)
+            continue
+        for _ in range(quantity):
+            for action in actions:
+                await _plan_action(plan, action, sampler)
+    return plan
+
+
+async def _plan_action(plan, action, sampler):
+    if isinstance(action, GiveCard):
+        plan.card_ids.append(action.card_id)
+    elif isinstance(action, GivePack):
+        plan.card_ids.extend(await sampler.draw_pack(action.pack_type))
+    elif isinstance(action, GiveCardByName):
+        card_id = _find_card_by_name(await catalog.get(), action.name)
+        if card_id is None:
+            logging.warning("Grant: %s card not found, fallback to card_id=%s", action.name, action.fallback_id)
+            card_id = action.fallback_id
+        plan.card_ids.append(card_id)
+    elif isinstance(action, AddShoppoints):
+        plan.shoppoints += action.amount
+    elif isinstance(action, StartSubscription):
+        plan.subscription = True
+    else:
+        raise TypeError(f"Unknown grant action {action!r}")
+
+
+async def _filmstrips_max_rowid(conn):
+    cur = await conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM filmstrips")
+    return (await cur.fetchone())[0]
+
+
+async def _write_plans(conn, plans):
+    """Statements for ``plans``, run by the SQLite writer inside its BEGIN IMMEDIATE transaction."""
+    now_ts = int(time.time())
+    lo_rowid = await _filmstrips_max_rowid(conn)
+    for p in plans:
+        if p.subscription:
+            cur = await conn.execute(
+                "UPDATE users SET subs = 1, days = ?, shoppoints = COALESCE(shoppoints, 0) + ? WHERE tg_id = ?",
+                (now_ts, p.shoppoints, p.tg_id),
+            )
+        elif p.shoppoints:
+            cur = await conn.execute(
+                "UPDATE users SET shoppoints = COALESCE(shoppoints, 0) + ? WHERE tg_id = ?", (p.shoppoints, p.tg_id)
+            )
+        else:
+            continue
+        if cur.rowcount == 0:
+            logging.warning("Grant: user tg_id=%s not found in users table", p.tg_id)
+    cards = [(p.tg_id, cid) for p in plans for cid in p.card_ids]
+    if cards:
+        await conn.executemany("INSERT INTO filmstrips (tg_id, card_id) VALUES (?, ?)", cards)
+    hi_rowid = await _filmstrips_max_rowid(conn)
+    return lo_rowid, hi_rowid, [cid for _, cid in cards]
+
+
+async def apply_plans(plans, writer=sqlite_writer):
+    """
+    Applies merged plans in one write transaction (one ``users`` UPDATE per user, one
+    ``executemany`` into filmstrips) and reports the new filmstrips rows to the ownership
+    cache. Subscriptions restart the 30-day count from now, like rq.changesubs in the bot.
+    Raises only if the transaction was not committed.
+    """
+    plans = [p for p in plans if p]
+    if not plans:
+        return
+    # The writer holds the lock from BEGIN IMMEDIATE, so rowids between lo and hi are ours only
+    lo_rowid, hi_rowid, card_ids = await writer.run(lambda conn: _write_plans(conn, plans))
+    try:
+        ownership.record_grants(lo_rowid, hi_rowid, card_ids)
+    except Exception as e:
+        # Committed already; the next ownership scan counts the rows
+        logging.warning(f"Grant: ownership cache update failed: {e}")
+    for p in plans:
+        logging.info("Grant: applied %r", p)
+
+
+async def grant_order(order, sampler=card_sampler):
+    """
+    Plans and applies the rewards for a paid order (order.user_id is the bot's tg_id).
+    If it raises, nothing was written; deduplication is the caller's job (fulfillment.py).
+    """
+    plan = await plan_items(GrantPlan(order.user_id), order.items, order.order_number, sampler)
+    if not plan:
+        logging.info("Grant: order %s has nothing to grant", order.order_number)
+        return plan
+    await apply_plans([plan])
+    return plan
@@ -0,0 +1,140 @@
+"""ETag / conditional GET and per-family Cache-Control for catalog JSON and static images."""
+import hashlib
+import logging
+from collections import OrderedDict
+
+from quart import current_app, g
+
+from config import Config
+from catalog import catalog
+from ownership import ownership
+
+
+def _needs_counts_cards(args):
+    return args.get("sort", "id") == "amount"
+
+
+def _needs_counts_catalog(args):
+    return bool(args.get("cards")) and args.get("sort", "id") == "amount"
+
+
+# endpoint -> whether its payload depends on ownership counts (bool or args predicate)
+CATALOG_ENDPOINTS = {
+    "get_seasons": False,
+    "get_season_info": False,
+    "get_cards": _needs_counts_cards,
+    "get_card_info": True,
+    "get_card_info_batch": True,
+    "get_catalog": _needs_counts_catalog,
+}
+
+STATIC_ENDPOINTS = {"serve_card_image", "serve_avatar", "serve_placeholder", "proxy_avatar"}
+
+CACHE_CONTROL = {
+    "catalog": Config.CACHE_CONTROL_CATALOG,
+    "static": Config.CACHE_CONTROL_STATIC,
+}
+
+
+class EncodedResponseCache:
+    """
+    Catalog ETag -> encoded body of the 200 response. The ETag already covers the catalog
+    version, ownership counts where they matter and the full URL, so a hit is served as-is
+    without running the handler or the JSON encoder. LRU, bounded by total body bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+    def get(self, etag):
+        body = self._entries.get(etag)
+        if body is None:
+            self._stats["misses"] += 1
+            return None
+        self._entries.move_to_end(etag)
+        self._stats["hits"] += 1
+        return body
+
+    def put(self, etag, body):
+        if len(body) > self.max_bytes or etag in self._entries:
+            return
+        self._entries[etag] = body
+        self._size += len(body)
+        self._stats["stored"] += 1
+        while self._size > self.max_bytes:
+            _, dropped = self._entries.popitem(last=False)
+            self._size -= len(dropped)
+            self._stats["evicted"] += 1
+
+    def stats(self):
+        return dict(self._stats, entries=len(self._entries), bytes=self._size)
+
+
+encoded_responses = EncodedResponseCache(Config.CATALOG_RESPONSE_CACHE_BYTES)
+
+
+def route_family(endpoint):
+    if endpoint in CATALOG_ENDPOINTS:
+        return "catalog"
+    if endpoint in STATIC_ENDPOINTS:
+        return "static"
+    return None
+
+
+async def catalog_etag(req):
+    """Strong ETag for a catalog request: cards content (+ ownership counts) and the full URL."""
+    needs_counts = CATALOG_ENDPOINTS[req.endpoint]
+    if callable(needs_counts):
+        needs_counts = needs_counts(req.args)
+    snap = await catalog.get()
+    parts = [req.endpoint, req.full_path, snap.digest]
+    if needs_counts:
+        await ownership.get()
+        parts.append(ownership.digest())
+    return hashlib.blake2b("|".join(parts).encode(), digest_size=16).hexdigest()
+
+
+def _has_live_fields(args):
+    # Comment counts are not part of the catalog digest: such responses get no ETag
+    return "comment_count" in args.get("include", "")
+
+
+async def not_modified(req):
+    """before_request: answers 304 for catalog GETs whose If-None-Match is still current."""
+    if req.method not in ("GET", "HEAD") or req.endpoint not in CATALOG_ENDPOINTS:
+        return None
+    if _has_live_fields(req.args):
+        return None
+    try:
+        etag = await catalog_etag(req)
+    except Exception as e:
+        logging.warning(f"ETag: could not compute catalog version: {e}")
+        return None
+    g.catalog_etag = etag
+    if req.if_none_match.contains_weak(etag):
+        return current_app.response_class("", status=304)
+    body = encoded_responses.get(etag)
+    if body is not None:
+        g.catalog_from_cache = True
+        return current_app.response_class(body, status=200, mimetype="application/json")
+    return None
+
+
+async def apply_cache_headers(req, response):
+    """after_request: ETag for catalog JSON (and its encoded body into the cache), Cache-Control per route family."""
+    family = route_family(req.endpoint)
+    if family is None:
+        return response
+    if response.status_code in (200, 206, 304):
+        cache_control = CACHE_CONTROL.get(family)
+        if cache_control:
+            response.headers["Cache-Control"] = cache_control
+        etag = g.get("catalog_etag")
+        if etag and family == "catalog":
+            response.set_etag(etag)
+            if response.status_code == 200 and response.mimetype == "application/json" and not g.get("catalog_from_cache"):
+                encoded_responses.put(etag, await response.get_data())
+    return response
@@ -0,0 +1,155 @@
+"""App-scoped httpx clients, one per upstream class, with per-host latency and connection-reuse metrics."""
+import time
+import logging
+from collections import deque
+
+import httpx
+
+from config import Config
+
+try:
+    import h2  # noqa: F401  (httpx needs it for http2=True)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class HostMetrics:
+    """Counters for one upstream host; latency is time to response headers."""
+
+    __slots__ = ("requests", "errors", "new_connections", "reused_connections", "total_ms", "max_ms", "recent_ms", "http_versions")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.recent_ms = deque(maxlen=256)
+        self.http_versions = {}
+
+    def observe(self, elapsed_ms, fresh, http_version=None):
+        self.requests += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.recent_ms.append(elapsed_ms)
+        if fresh:
+            self.new_connections += 1
+        else:
+            self.reused_connections += 1
+        if http_version:
+            self.http_versions[http_version] = self.http_versions.get(http_version, 0) + 1
+
+    def as_dict(self):
+        recent = sorted(self.recent_ms)
+        done = self.requests or 1
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "reuse_ratio": round(self.reused_connections / done, 3),
+            "avg_ms": round(self.total_ms / done, 1),
+            "p95_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1) if recent else None,
+            "max_ms": round(self.max_ms, 1),
+            "http_versions": dict(self.http_versions),
+        }
+
+
+class _MeteredTransport(httpx.AsyncHTTPTransport):
+    """Pooled transport that records per-host latency and whether the request opened a new connection."""
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = metrics
+
+    async def handle_async_request(self, request):
+        host = request.url.host
+        metrics = self._metrics.get(host)
+        if metrics is None:
+            metrics = self._metrics[host] = HostMetrics()
+        fresh = False
+
+        async def trace(event_name, info):
+            nonlocal fresh
+            if event_name == "connection.connect_tcp.complete":
+                fresh = True
+
+        request.extensions = dict(request.extensions, trace=trace)
+        started = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            metrics.errors += 1
+            raise
+        http_version = response.extensions.get("http_version", b"").decode() or None
+        metrics.observe((time.perf_counter() - started) * 1000, fresh, http_version)
+        return response
+
+
+class HttpClients:
+    """
+    Long-lived httpx clients keyed by upstream class ("telegram" for the Telegram CDN,
+    "notify" for the purchase_notify webhook). ``start``/``close`` are hooked to
+    before_serving/after_serving; ``get`` builds a client lazily when used outside the app.
+    """
+
+    PROFILES = {
+        "telegram": {
+            "timeout": httpx.Timeout(15.0, connect=5.0),
+            "follow_redirects": True,
+        },
+        "notify": {
+            "timeout": httpx.Timeout(10.0, connect=3.0),
+        },
+    }
+
+    def __init__(self):
+        self._clients = {}
+        self._metrics = {}
+
+    def _build(self, name):
+        metrics = self._metrics.setdefault(name, {})
+        limits = httpx.Limits(
+            max_connections=Config.HTTP_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.HTTP_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY,
+        )
+        http2 = Config.HTTP2_ENABLED and HTTP2_AVAILABLE
+        transport = _MeteredTransport(metrics, http2=http2, limits=limits, retries=1)
+        return httpx.AsyncClient(transport=transport, **self.PROFILES[name])
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._build(name)
+        return client
+
+    @property
+    def telegram(self):
+        return self.get("telegram")
+
+    @property
+    def notify(self):
+        return self.get("notify")
+
+    async def start(self):
+        for name in self.PROFILES:
+            self.get(name)
+        if Config.HTTP2_ENABLED and not HTTP2_AVAILABLE:
+            logging.info("HTTP clients: h2 not installed, using HTTP/1.1 keep-alive only")
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self):
+        return {
+            name: {host: m.as_dict() for host, m in hosts.items()}
+            for name, hosts in self._metrics.items()
+        }
+
+
+http_clients = HttpClients()
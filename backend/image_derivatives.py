@@ -0,0 +1,270 @@
+"""
+Resized / re-encoded variants of card images (``/card_imgs/<file>?w=256&fmt=webp``).
+
+Rendering runs in a process pool; results are stored on disk under a key made of the
+source's content hash and the parameters, so a replaced image never serves a stale
+variant. The directory is trimmed LRU by mtime (touched on every hit) to ``disk_bytes``.
+Pillow is optional: without it ``available`` is False and callers serve the original.
+"""
+import io
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from config import Config
+from uploads import CARD_IMG_DIR
+
+try:
+    from PIL import Image, features
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+    features = None
+
+# fmt query value -> (Pillow format, content type)
+FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+
+
+class Unrenderable(Exception):
+    """The source cannot be turned into a still derivative (animated GIF, unreadable file)."""
+
+
+def _supported_formats():
+    if Image is None:
+        return set()
+    supported = {"jpeg", "png"}
+    for fmt in ("webp", "avif"):
+        try:
+            if features.check(fmt):
+                supported.add(fmt)
+        except Exception:
+            pass
+    return supported
+
+
+def _render(src_path, width, pil_format, quality):
+    """Runs in a worker process: returns the encoded derivative."""
+    with Image.open(src_path) as im:
+        if getattr(im, "is_animated", False):
+            raise Unrenderable("animated image")
+        if im.width > width:
+            im.thumbnail((width, im.height), Image.LANCZOS)
+        else:
+            im.load()
+        if pil_format == "JPEG" and im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        elif im.mode == "P":
+            im = im.convert("RGBA")
+        out = io.BytesIO()
+        im.save(out, pil_format, quality=quality, optimize=pil_format in ("JPEG", "PNG"))
+        return out.getvalue()
+
+
+class ImageDerivatives:
+    def __init__(self, source_dir, cache_dir, widths, default_format, disk_bytes, workers, quality, pregenerate):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.widths = tuple(sorted(widths))
+        self.default_format = default_format
+        self.disk_bytes = disk_bytes
+        self.workers = max(1, int(workers))
+        self.quality = quality
+        self.pregenerate_specs = pregenerate
+        self.formats = _supported_formats()
+        self._pool = None
+        self._source_digests = {}  # filename -> ((ino, size, mtime_ns), sha256)
+        self._inflight = {}
+        self._background = set()
+        self._disk_size = None
+        self._stats = {"hits": 0, "renders": 0, "coalesced": 0, "unrenderable": 0, "render_s_total": 0.0, "evicted": 0, "pregenerated": 0}
+
+    @property
+    def available(self):
+        return bool(self.formats)
+
+    def parse(self, args):
+        """(width, fmt) from the query string, None if no variant was asked for; ValueError if not allowed."""
+        w = args.get("w")
+        fmt = args.get("fmt")
+        if w is None and fmt is None:
+            return None
+        width = int(w) if w is not None else self.widths[-1]
+        if width not in self.widths:
+            raise ValueError(f"w must be one of {', '.join(map(str, self.widths))}")
+        fmt = (fmt or self.default_format).lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in FORMATS:
+            raise ValueError(f"fmt must be one of {', '.join(sorted(FORMATS))}")
+        return width, fmt
+
+    def _source_digest(self, filename):
+        path = os.path.join(self.source_dir, filename)
+        st = os.stat(path)
+        version = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._source_digests.get(filename)
+        if cached is not None and cached[0] == version:
+            return path, cached[1]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._source_digests[filename] = (version, digest)
+        return path, digest
+
+    def _cache_path(self, key, fmt):
+        return os.path.join(self.cache_dir, f"{key}.{fmt}")
+
+    def _lookup(self, filename, width, fmt):
+        """Worker thread: (source path, key, cached path or None)."""
+        src, digest = self._source_digest(filename)
+        key = hashlib.sha256(f"{digest}:{width}:{fmt}:{self.quality}".encode()).hexdigest()
+        path = self._cache_path(key, fmt)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return src, key, None
+        return src, key, path
+
+    async def get(self, filename, width, fmt):
+        """
+        (path, content_type, etag) of the derivative, rendering it if needed.
+        Raises FileNotFoundError for an unknown source, Unrenderable when there is no still variant.
+        """
+        if fmt not in self.formats:
+            raise Unrenderable(f"{fmt} is not supported by this Pillow build")
+        src, key, path = await asyncio.to_thread(self._lookup, filename, width, fmt)
+        if path is not None:
+            self._stats["hits"] += 1
+        else:
+            path = await self._render_once(src, key, width, fmt)
+        return path, FORMATS[fmt][1], key[:32]
+
+    async def _render_once(self, src, key, width, fmt):
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(task)
+        task = asyncio.ensure_future(self._render(src, key, width, fmt))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _render(self, src, key, width, fmt):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        started = time.perf_counter()
+        try:
+            body = await asyncio.get_running_loop().run_in_executor(
+                self._pool, _render, src, width, FORMATS[fmt][0], self.quality
+            )
+        except Unrenderable:
+            self._stats["unrenderable"] += 1
+            raise
+        except Exception as e:
+            self._stats["unrenderable"] += 1
+            raise Unrenderable(str(e)) from e
+        self._stats["renders"] += 1
+        self._stats["render_s_total"] += time.perf_counter() - started
+        return await asyncio.to_thread(self._store, key, fmt, body)
+
+    def _store(self, key, fmt, body):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(key, fmt)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
+        if self._disk_size is not None:
+            self._disk_size += len(body)
+        self._trim_disk()
+        return path
+
+    def _trim_disk(self):
+        if self._disk_size is not None and self._disk_size <= self.disk_bytes:
+            return
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        self._disk_size = sum(e[1] for e in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if self._disk_size <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_size -= size
+            self._stats["evicted"] += 1
+
+    def pregenerate(self, filename):
+        """Renders the configured variants of a newly stored image in the background."""
+        if not self.available or not self.pregenerate_specs:
+            return
+        task = asyncio.ensure_future(self._pregenerate(filename))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _pregenerate(self, filename):
+        for width, fmt in self.pregenerate_specs:
+            if fmt not in self.formats:
+                continue
+            try:
+                await self.get(filename, width, fmt)
+                self._stats["pregenerated"] += 1
+            except Unrenderable:
+                return
+            except Exception as e:
+                logging.warning(f"Image derivatives: pregenerating {filename} w={width} fmt={fmt} failed: {e}")
+                return
+
+    async def close(self):
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._background, return_exceptions=True)
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        renders = self._stats["renders"]
+        return dict(
+            self._stats,
+            render_avg_s=(self._stats["render_s_total"] / renders) if renders else 0.0,
+            formats=sorted(self.formats),
+            disk_bytes=self._disk_size,
+            inflight=len(self._inflight),
+        )
+
+
+def _parse_specs(value):
+    specs = []
+    for item in value.split(","):
+        item = item.strip()
+        if item:
+            width, _, fmt = item.partition(":")
+            specs.append((int(width), (fmt or "webp").lower()))
+    return specs
+
+
+image_derivatives = ImageDerivatives(
+    CARD_IMG_DIR,
+    Config.CARD_IMAGE_CACHE_DIR,
+    widths=[int(w) for w in Config.CARD_IMAGE_WIDTHS.split(",") if w.strip()],
+    default_format=Config.CARD_IMAGE_DEFAULT_FORMAT,
+    disk_bytes=Config.CARD_IMAGE_CACHE_DISK_BYTES,
+    workers=Config.CARD_IMAGE_WORKERS,
+    quality=Config.CARD_IMAGE_QUALITY,
+    pregenerate=_parse_specs(Config.CARD_IMAGE_PREGENERATE),
+)
@@ -0,0 +1,58 @@
+"""orjson-backed JSON provider for the Quart app (used when orjson is installed)."""
+import uuid
+import decimal
+import dataclasses
+
+from quart.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+# Naive datetimes in the models are UTC (datetime.utcnow); int keys (card_id -> count) become strings
+_OPTIONS = (orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS) if orjson is not None else 0
+
+
+def _default(o):
+    if isinstance(o, decimal.Decimal):
+        # Money: keep the exact value, as the stdlib provider did
+        return str(o)
+    if isinstance(o, uuid.UUID):
+        return str(o)
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    Same contract as Quart's default provider, encoded by orjson: datetimes as ISO 8601 (UTC),
+    Decimal as a string. ``response`` hands the encoded bytes to the response without a str
+    round trip. Keys are not sorted.
+    """
+
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS).decode()
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def install(app):
+    """Switches ``app`` to the orjson provider; keeps the default one if orjson is missing."""
+    if orjson is None:
+        return False
+    app.json = OrjsonProvider(app)
+    return True
@@ -0,0 +1,46 @@
+"""Add fulfillment_jobs table
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "003"
+down_revision = "002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "fulfillment_jobs",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("order_id", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String(20), nullable=False, server_default="pending"),
+        sa.Column("granted", sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column("notified", sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_error", sa.String(512), nullable=True),
+        sa.Column("run_after", sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column("locked_until", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.ForeignKeyConstraint(["order_id"], ["orders.id"], ondelete="CASCADE"),
+        sa.UniqueConstraint("order_id"),
+    )
+    # Claim query: open jobs that are due
+    op.create_index(
+        "ix_fulfillment_jobs_claim",
+        "fulfillment_jobs",
+        ["run_after"],
+        postgresql_where=sa.text("status IN ('pending', 'running')"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_fulfillment_jobs_claim", table_name="fulfillment_jobs")
+    op.drop_table("fulfillment_jobs")
@@ -0,0 +1,46 @@
+"""Add notification_outbox table
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSON
+
+revision = "004"
+down_revision = "003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "notification_outbox",
+        sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column("message_id", sa.String(128), nullable=False),
+        sa.Column("order_id", sa.Integer(), nullable=True),
+        sa.Column("payload", JSON, nullable=False),
+        sa.Column("status", sa.String(20), nullable=False, server_default="pending"),
+        sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_error", sa.String(512), nullable=True),
+        sa.Column("next_attempt_at", sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("sent_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.ForeignKeyConstraint(["order_id"], ["orders.id"], ondelete="CASCADE"),
+        sa.UniqueConstraint("message_id"),
+    )
+    # Sender drain query: due pending messages
+    op.create_index(
+        "ix_notification_outbox_due",
+        "notification_outbox",
+        ["next_attempt_at"],
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_notification_outbox_due", table_name="notification_outbox")
+    op.drop_table("notification_outbox")
@@ -0,0 +1,25 @@
+"""Add orders indexes for the reconciliation sweeper
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+
+revision = "005"
+down_revision = "004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Sweeper scans: abandoned pending orders / paid orders without a job, oldest first
+    op.create_index("ix_orders_status_updated_at", "orders", ["status", "updated_at"])
+    # Sweeper scan: orders whose notification failed
+    op.create_index("ix_orders_notification_status", "orders", ["notification_status"])
+
+
+def downgrade():
+    op.drop_index("ix_orders_notification_status", table_name="orders")
+    op.drop_index("ix_orders_status_updated_at", table_name="orders")
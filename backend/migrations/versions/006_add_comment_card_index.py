@@ -0,0 +1,26 @@
+"""Add (card_id, id) index on comment
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "006"
+down_revision = "005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # comment is created outside these migrations (legacy schema); skip if it is not there yet
+    if not sa.inspect(op.get_bind()).has_table("comment"):
+        return
+    # Per-card listing (keyset on id) and per-card counts, both index-only
+    op.execute("CREATE INDEX IF NOT EXISTS ix_comment_card_id_id ON comment (card_id, id)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS ix_comment_card_id_id")
@@ -0,0 +1,22 @@
+"""Add fulfillment_jobs.grant_started_at
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "007"
+down_revision = "006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("fulfillment_jobs", sa.Column("grant_started_at", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("fulfillment_jobs", "grant_started_at")
@@ -0,0 +1,28 @@
+"""Add partial index for accepted notification_outbox rows
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "008"
+down_revision = "007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Status poll: accepted messages whose next check is due
+    op.create_index(
+        "ix_notification_outbox_accepted",
+        "notification_outbox",
+        ["next_attempt_at"],
+        postgresql_where=sa.text("status = 'accepted'"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_notification_outbox_accepted", table_name="notification_outbox")
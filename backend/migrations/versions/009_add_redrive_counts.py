@@ -0,0 +1,24 @@
+"""Add redrive_count to fulfillment_jobs and notification_outbox
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "009"
+down_revision = "008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("fulfillment_jobs", sa.Column("redrive_count", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("notification_outbox", sa.Column("redrive_count", sa.Integer(), nullable=False, server_default="0"))
+
+
+def downgrade():
+    op.drop_column("notification_outbox", "redrive_count")
+    op.drop_column("fulfillment_jobs", "redrive_count")
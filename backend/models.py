@@ -1,7 +1,7 @@
 from decimal import Decimal
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import BigInteger, Numeric, DateTime, JSON, String, Integer, Text, ForeignKey
+from sqlalchemy import BigInteger, Boolean, Numeric, DateTime, JSON, String, Integer, Text, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -46,7 +46,10 @@ class Card(Base):
     season_id: Mapped[int] = mapped_column(Integer, ForeignKey("season.id", ondelete="CASCADE"), nullable=False)
 
     season = relationship("Season", backref="cards")
-    comments = relationship("Comment", lazy="selectin", cascade="all, delete-orphan", back_populates="card")
+    # Not loaded with the card: list comments via comments.fetch_comments; rows go with ON DELETE CASCADE
+    comments = relationship(
+        "Comment", lazy="raise_on_sql", cascade="all, delete-orphan", passive_deletes=True, back_populates="card"
+    )
 
     def present(self):
         return {
@@ -62,6 +65,7 @@ class Card(Base):
 
 class Comment(Base):
     __tablename__ = "comment"
+    __table_args__ = (Index("ix_comment_card_id_id", "card_id", "id"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     uuid: Mapped[str] = mapped_column(String, nullable=False, unique=True)
     user_id: Mapped[int] = mapped_column(Integer, nullable=False)
@@ -91,3 +95,44 @@ class Order(Base):
 
     def __repr__(self):
         return f"<Order {self.order_number} status={self.status}>"
+
+
+class FulfillmentJob(Base):
+    """One per paid order: grant items, then notify the bot. Claimed by fulfillment workers under a lease."""
+    __tablename__ = "fulfillment_jobs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    order_id: Mapped[int] = mapped_column(Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, unique=True)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")  # pending / running / done / failed
+    granted: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    notified: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    # Set before the bot DB write, cleared if it rolled back: set with granted=False means the outcome is unknown
+    grant_started_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    redrive_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # re-drives by reconcile.py
+    last_error: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+    run_after: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<FulfillmentJob order_id={self.order_id} status={self.status} granted={self.granted} notified={self.notified}>"
+
+
+class NotificationOutbox(Base):
+    """Purchase notifications waiting for purchase_notify; ``message_id`` is the dedup key on both sides."""
+    __tablename__ = "notification_outbox"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    message_id: Mapped[str] = mapped_column(String(128), nullable=False, unique=True)
+    order_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=True)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default="pending")  # pending / accepted / sent / failed
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    redrive_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # re-drives by reconcile.py
+    last_error: Mapped[Optional[str]] = mapped_column(String(512), nullable=True)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<NotificationOutbox {self.message_id} status={self.status} attempts={self.attempts}>"
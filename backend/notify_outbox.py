@@ -0,0 +1,297 @@
+"""
+Purchase notification outbox: fulfillment writes a row per order, ``OutboxSender`` drains due
+rows in batches to purchase_notify's bulk endpoint and applies its per-message acks.
+
+Rows are claimed with ``FOR UPDATE SKIP LOCKED`` under a lease, so senders in several app
+processes never post the same message at once; purchase_notify also dedups on ``message_id``,
+so a batch re-sent after a lost response is not delivered twice.
+
+An ``accepted`` ack only means purchase_notify spooled the message. Such rows (and their
+orders) stay ``accepted`` and are polled on its status endpoint every ``status_interval``
+until the message is ``sent`` or ``dropped``; a dropped one becomes ``failed``, which the
+reconciler re-drives.
+"""
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from config import Config
+from models import Order, NotificationOutbox
+from async_db import get_async_session
+from http_clients import http_clients
+
+
+def purchase_payload(order):
+    """Webhook body for one paid order (same shape purchase_notify has always accepted)."""
+    return {
+        "event": "purchase_complete",
+        "order_id": order.id,
+        "order_number": order.order_number,
+        "user_id": order.user_id,
+        "items": [
+            {"id": it.get("id"), "name": it.get("name"), "price": float(it.get("price", 0)), "quantity": int(it.get("quantity", 1))}
+            for it in (order.items or [])
+        ],
+        "total_amount": str(order.amount),
+        "currency": order.currency or "RUB",
+        "completed_at": datetime.utcnow().isoformat() + "Z",
+    }
+
+
+async def enqueue_notification(db_session, order):
+    """Adds the order's notification to the outbox once (a repeat for the same order is a no-op)."""
+    stmt = (
+        pg_insert(NotificationOutbox)
+        .values(
+            message_id=f"order:{order.order_number}",
+            order_id=order.id,
+            payload=purchase_payload(order),
+            status="pending",
+            attempts=0,
+            next_attempt_at=datetime.utcnow(),
+            created_at=datetime.utcnow(),
+        )
+        .on_conflict_do_nothing(index_elements=["message_id"])
+    )
+    await db_session.execute(stmt)
+
+
+class OutboxSender:
+    """Drains the outbox: ``batch_size`` messages per POST, backoff per message from the acks."""
+
+    # Per-message acks from purchase_notify: "accepted" = spooled there, "duplicate" = already spooled or sent;
+    # both are confirmed later through the status endpoint
+    DELIVERED = ("sent",)
+    ACCEPTED = ("accepted", "duplicate")
+
+    def __init__(
+        self,
+        url,
+        status_url=None,
+        batch_size=50,
+        poll_interval=2.0,
+        status_interval=60.0,
+        lease=120.0,
+        max_attempts=10,
+        retry_base=5.0,
+        retry_max=900.0,
+    ):
+        self.url = url
+        self.status_url = status_url
+        self.status_interval = status_interval
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._task = None
+        self._wakeup = None
+        self._stats = {
+            "batches": 0, "accepted": 0, "sent": 0, "retried": 0, "failed": 0, "post_errors": 0,
+            "status_checks": 0, "status_errors": 0, "dropped": 0, "resubmitted": 0,
+        }
+
+    async def start(self):
+        if self._task is not None:
+            return
+        if not self.url:
+            logging.info("Notify outbox: BOT_PURCHASE_NOTIFY_BULK_URL not set, sender disabled")
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                drained = await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Notify outbox: drain failed: {e}")
+                drained = 0
+            try:
+                await self.check_accepted_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Notify outbox: status check failed: {e}")
+            if drained >= self.batch_size:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self):
+        now = datetime.utcnow()
+        async with get_async_session() as db_session:
+            r = await db_session.execute(
+                select(NotificationOutbox)
+                .where(
+                    NotificationOutbox.status == "pending",
+                    NotificationOutbox.next_attempt_at <= now,
+                )
+                .order_by(NotificationOutbox.next_attempt_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            rows = r.scalars().all()
+            for row in rows:
+                row.attempts += 1
+                # Lease: the row stays "pending" but is not due again until the lease runs out
+                row.next_attempt_at = now + timedelta(seconds=self.lease)
+            return [(row.id, row.message_id, row.order_id, row.attempts, row.payload) for row in rows]
+
+    async def drain_once(self):
+        """Sends one batch; returns how many messages were claimed."""
+        batch = await self._claim()
+        if not batch:
+            return 0
+        self._stats["batches"] += 1
+        messages = [dict(payload, message_id=message_id) for _, message_id, _, _, payload in batch]
+        try:
+            r = await http_clients.notify.post(self.url, json={"messages": messages}, headers=self._headers())
+            r.raise_for_status()
+            results = {res.get("message_id"): res for res in r.json().get("results", [])}
+        except Exception as e:
+            self._stats["post_errors"] += 1
+            logging.warning(f"Notify outbox: bulk POST of {len(batch)} messages failed: {e}")
+            results = {}
+        await self._apply(batch, results)
+        return len(batch)
+
+    def _headers(self):
+        headers = {}
+        if Config.BOT_PURCHASE_WEBHOOK_SECRET:
+            headers["Authorization"] = f"Bearer {Config.BOT_PURCHASE_WEBHOOK_SECRET}"
+        return headers
+
+    async def _claim_accepted(self):
+        now = datetime.utcnow()
+        async with get_async_session() as db_session:
+            r = await db_session.execute(
+                select(NotificationOutbox)
+                .where(NotificationOutbox.status == "accepted", NotificationOutbox.next_attempt_at <= now)
+                .order_by(NotificationOutbox.next_attempt_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            rows = r.scalars().all()
+            for row in rows:
+                row.next_attempt_at = now + timedelta(seconds=self.status_interval)
+            return [(row.id, row.message_id, row.order_id) for row in rows]
+
+    async def check_accepted_once(self):
+        """Asks purchase_notify what became of one batch of accepted messages; returns how many were checked."""
+        if not self.status_url:
+            return 0
+        batch = await self._claim_accepted()
+        if not batch:
+            return 0
+        self._stats["status_checks"] += 1
+        try:
+            r = await http_clients.notify.post(
+                self.status_url, json={"message_ids": [message_id for _, message_id, _ in batch]}, headers=self._headers()
+            )
+            r.raise_for_status()
+            results = {res.get("message_id"): res for res in r.json().get("results", [])}
+        except Exception as e:
+            # The rows were pushed out by status_interval when claimed and are asked about again then
+            self._stats["status_errors"] += 1
+            logging.warning(f"Notify outbox: status query for {len(batch)} messages failed: {e}")
+            return len(batch)
+        now = datetime.utcnow()
+        async with get_async_session() as db_session:
+            for row_id, message_id, order_id in batch:
+                res = results.get(message_id) or {}
+                status = res.get("status")
+                error = (res.get("error") or "")[:512] or None
+                if status == "sent":
+                    values = {"status": "sent", "sent_at": now, "last_error": None}
+                    order_status = "sent"
+                elif status == "dropped":
+                    values = {"status": "failed", "last_error": error or "dropped by purchase_notify"}
+                    order_status = "failed"
+                    self._stats["dropped"] += 1
+                    logging.error(f"Notify outbox: {message_id} was dropped by purchase_notify: {error}")
+                elif status == "unknown":
+                    # purchase_notify has no record of it (spool lost): submit it again
+                    values = {"status": "pending", "next_attempt_at": now}
+                    order_status = "queued"
+                    self._stats["resubmitted"] += 1
+                else:
+                    continue
+                if order_status in ("sent", "failed"):
+                    self._stats[order_status] += 1
+                await db_session.execute(update(NotificationOutbox).where(NotificationOutbox.id == row_id).values(**values))
+                if order_id:
+                    await db_session.execute(
+                        update(Order)
+                        .where(Order.id == order_id)
+                        .values(notification_status=order_status, notification_error=values.get("last_error"))
+                    )
+        if any((results.get(m) or {}).get("status") == "unknown" for _, m, _ in batch):
+            self.wake()
+        return len(batch)
+
+    def _retry_delay(self, attempts, retry_after=None):
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+        return max(delay, float(retry_after or 0))
+
+    async def _apply(self, batch, results):
+        now = datetime.utcnow()
+        async with get_async_session() as db_session:
+            for row_id, message_id, order_id, attempts, _ in batch:
+                res = results.get(message_id) or {"status": "retry", "error": "no ack"}
+                status = res.get("status")
+                error = (res.get("error") or "")[:512] or None
+                if status in self.DELIVERED:
+                    values = {"status": "sent", "sent_at": now, "last_error": None}
+                    order_status = "sent"
+                elif status in self.ACCEPTED:
+                    # Confirmed (or reported dropped) later by check_accepted_once
+                    values = {"status": "accepted", "last_error": None, "next_attempt_at": now + timedelta(seconds=self.status_interval)}
+                    order_status = "accepted"
+                elif status == "failed" or attempts >= self.max_attempts:
+                    values = {"status": "failed", "last_error": error}
+                    order_status = "failed"
+                    logging.error(f"Notify outbox: {message_id} failed after {attempts} attempts: {error}")
+                else:
+                    delay = self._retry_delay(attempts, res.get("retry_after"))
+                    values = {"last_error": error, "next_attempt_at": now + timedelta(seconds=delay)}
+                    order_status = None
+                self._stats["retried" if order_status is None else order_status] += 1
+                await db_session.execute(update(NotificationOutbox).where(NotificationOutbox.id == row_id).values(**values))
+                if order_status and order_id:
+                    await db_session.execute(
+                        update(Order).where(Order.id == order_id).values(notification_status=order_status, notification_error=error)
+                    )
+
+    def stats(self):
+        return dict(self._stats, running=self._task is not None)
+
+
+outbox_sender = OutboxSender(
+    Config.BOT_PURCHASE_NOTIFY_BULK_URL,
+    status_url=Config.BOT_PURCHASE_NOTIFY_STATUS_URL,
+    batch_size=Config.NOTIFY_BATCH_SIZE,
+    poll_interval=Config.NOTIFY_POLL_INTERVAL,
+    status_interval=Config.NOTIFY_STATUS_INTERVAL,
+    max_attempts=Config.NOTIFY_MAX_ATTEMPTS,
+)
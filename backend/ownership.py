@@ -0,0 +1,120 @@
+"""Materialized per-card ownership counts over the bot's ``filmstrips`` table."""
+import time
+import asyncio
+import hashlib
+import logging
+
+from config import Config
+from async_db import sqlite_pool
+
+
+class OwnershipCounts:
+    """
+    card_id -> number of filmstrips, kept in memory.
+
+    Filled by one grouped scan up to a rowid high-water mark; afterwards only rows
+    above the mark are counted (the bot's inserts). The backend's own grants are
+    applied directly via ``record_grants``. Rows deleted by the bot are only seen
+    by the periodic full rescan (``rescan_interval``).
+    """
+
+    def __init__(self, pool, rescan_interval=300.0):
+        self.pool = pool
+        self.rescan_interval = rescan_interval
+        self.hwm = None
+        self.version = 0  # bumped whenever any count changes
+        self._counts = {}
+        self._digest = None
+        self._scanned_at = 0.0
+        self._seen = None
+        self._lock = None
+        self._stats = {"full_scans": 0, "incremental_scans": 0, "local_grants": 0}
+
+    def _fresh(self):
+        return (
+            self.hwm is not None
+            and self._seen == self.pool.signature()
+            and time.monotonic() - self._scanned_at < self.rescan_interval
+        )
+
+    async def get(self):
+        """Brings the counts up to date and returns the card_id -> count mapping (read-only)."""
+        if not self._fresh():
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if not self._fresh():
+                    await self._refresh()
+        return self._counts
+
+    async def count(self, card_id):
+        return (await self.get()).get(card_id, 0)
+
+    async def _refresh(self):
+        signature = self.pool.signature()
+        async with self.pool.connection() as conn:
+            if self.hwm is None or time.monotonic() - self._scanned_at >= self.rescan_interval:
+                await self._full_scan(conn)
+            else:
+                await self._incremental_scan(conn)
+        self._seen = signature
+
+    async def _full_scan(self, conn):
+        async with conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM filmstrips") as cur:
+            hwm = (await cur.fetchone())[0]
+        async with conn.execute(
+            "SELECT card_id, COUNT(*) FROM filmstrips WHERE rowid <= ? GROUP BY card_id", (hwm,)
+        ) as cur:
+            counts = {row[0]: row[1] for row in await cur.fetchall()}
+        self._counts = counts
+        self.hwm = hwm
+        self.version += 1
+        self._scanned_at = time.monotonic()
+        self._stats["full_scans"] += 1
+        logging.debug(f"Ownership counts: full scan, {len(counts)} cards, hwm={hwm}")
+
+    async def _incremental_scan(self, conn):
+        async with conn.execute(
+            "SELECT card_id, COUNT(*), MAX(rowid) FROM filmstrips WHERE rowid > ? GROUP BY card_id", (self.hwm,)
+        ) as cur:
+            rows = await cur.fetchall()
+        counts = self._counts
+        hwm = self.hwm
+        for card_id, n, max_rowid in rows:
+            counts[card_id] = counts.get(card_id, 0) + n
+            hwm = max(hwm, max_rowid)
+        self.hwm = hwm
+        if rows:
+            self.version += 1
+        self._stats["incremental_scans"] += 1
+
+    def record_grants(self, lo_rowid, hi_rowid, card_ids):
+        """
+        Applies filmstrips committed by the backend in rowids (lo_rowid, hi_rowid].
+        Only done when nothing unseen sits below them; otherwise the next
+        incremental scan counts them together with the bot's rows.
+        """
+        if self.hwm is None or self.hwm != lo_rowid or hi_rowid <= lo_rowid:
+            return
+        if self._lock is not None and self._lock.locked():
+            # A scan is in flight and may or may not include these rows
+            return
+        counts = self._counts
+        for card_id in card_ids:
+            counts[card_id] = counts.get(card_id, 0) + 1
+        self.hwm = hi_rowid
+        self.version += 1
+        self._stats["local_grants"] += len(card_ids)
+
+    def digest(self):
+        """Content hash of the counts (same in every worker), memoised per version."""
+        if self._digest is None or self._digest[0] != self.version:
+            h = hashlib.blake2b(repr(sorted(self._counts.items())).encode(), digest_size=16).hexdigest()
+            self._digest = (self.version, h)
+        return self._digest[1]
+
+    def stats(self):
+        return dict(self._stats, hwm=self.hwm, version=self.version, cards=len(self._counts))
+
+
+ownership = OwnershipCounts(sqlite_pool, rescan_interval=Config.OWNERSHIP_RESCAN_INTERVAL)
@@ -0,0 +1,236 @@
+"""
+Reconciliation sweeper: picks up orders the normal pipeline left behind.
+
+Each sweep, in bounded batches:
+- expires pending orders that never got a payment callback (``PENDING_ORDER_TTL``);
+- enqueues a fulfillment job for paid orders that have none (paid outside ``mark_order_paid``);
+- re-drives fulfillment jobs and notifications that ended up ``failed``, once they have been
+  failed for ``RECONCILE_REDRIVE_AFTER``, at most ``RECONCILE_MAX_REDRIVES`` times each; after
+  that they stay ``failed`` for an operator.
+
+Runs in-process every ``RECONCILE_INTERVAL`` seconds, or once per invocation with
+``python reconcile.py`` (cron). A sweep holds a transaction-level advisory lock, so only one
+process sweeps at a time.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func, literal, exists, false
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from config import Config
+from models import Order, FulfillmentJob, NotificationOutbox
+from async_db import get_async_session
+from fulfillment import fulfillment_worker
+from notify_outbox import enqueue_notification, outbox_sender
+
+# pg_advisory lock key for the sweep ("reconcil")
+SWEEP_LOCK_KEY = 0x7265636F6E63696C
+
+
+class OrderReconciler:
+    def __init__(
+        self,
+        interval=300.0,
+        batch_size=100,
+        pending_ttl=24 * 3600,
+        redrive_after=6 * 3600,
+        paid_grace=300.0,
+        lookback=7 * 24 * 3600,
+        max_redrives=3,
+    ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending_ttl = pending_ttl
+        self.redrive_after = redrive_after
+        self.paid_grace = paid_grace
+        self.lookback = lookback
+        self.max_redrives = max_redrives
+        self._task = None
+        self._stats = {"sweeps": 0, "skipped": 0, "expired": 0, "jobs_created": 0, "jobs_redriven": 0, "notifications_redriven": 0}
+
+    async def start(self):
+        if self._task is not None or self.interval <= 0:
+            return
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Reconcile: sweep failed: {e}")
+
+    async def sweep_once(self):
+        """Runs one sweep; returns per-step counts, or None if another process holds the sweep lock."""
+        now = datetime.utcnow()
+        async with get_async_session() as db_session:
+            r = await db_session.execute(select(func.pg_try_advisory_xact_lock(SWEEP_LOCK_KEY)))
+            if not r.scalar():
+                self._stats["skipped"] += 1
+                return None
+            counts = {
+                "expired": await self._expire_pending(db_session, now),
+                "jobs_created": await self._enqueue_missing_jobs(db_session, now),
+                "jobs_redriven": await self._redrive_failed_jobs(db_session, now),
+                "notifications_redriven": await self._redrive_notifications(db_session, now),
+            }
+        self._stats["sweeps"] += 1
+        for k, v in counts.items():
+            self._stats[k] += v
+        if any(counts.values()):
+            logging.info("Reconcile: %s", counts)
+        if counts["jobs_created"] or counts["jobs_redriven"]:
+            fulfillment_worker.wake()
+        if counts["notifications_redriven"]:
+            outbox_sender.wake()
+        return counts
+
+    async def _expire_pending(self, db_session, now):
+        # A late callback for an expired order still goes through (mark_order_paid accepts "expired")
+        stale = (
+            select(Order.id)
+            .where(Order.status == "pending", Order.updated_at < now - timedelta(seconds=self.pending_ttl))
+            .order_by(Order.updated_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        r = await db_session.execute(
+            update(Order).where(Order.id.in_(stale)).values(status="expired", updated_at=now).returning(Order.id)
+        )
+        return len(r.all())
+
+    async def _enqueue_missing_jobs(self, db_session, now):
+        # Only orders that were never notified: a paid order with notification_status sent/failed/skipped
+        # went through the old inline grant and must not be granted again
+        orphans = (
+            select(Order.id, literal("pending"), false(), false(), literal(0), literal(now), literal(now), literal(now))
+            .where(
+                Order.status == "paid",
+                Order.updated_at < now - timedelta(seconds=self.paid_grace),
+                Order.updated_at >= now - timedelta(seconds=self.lookback),
+                Order.notification_status.is_(None) | (Order.notification_status == "pending"),
+                ~exists().where(FulfillmentJob.order_id == Order.id),
+            )
+            .order_by(Order.updated_at)
+            .limit(self.batch_size)
+        )
+        r = await db_session.execute(
+            pg_insert(FulfillmentJob)
+            .from_select(
+                ["order_id", "status", "granted", "notified", "attempts", "run_after", "created_at", "updated_at"], orphans
+            )
+            .on_conflict_do_nothing(index_elements=["order_id"])
+            .returning(FulfillmentJob.order_id)
+        )
+        created = r.scalars().all()
+        for order_id in created:
+            logging.warning(f"Reconcile: paid order id={order_id} had no fulfillment job, enqueued one")
+        return len(created)
+
+    async def _redrive_failed_jobs(self, db_session, now):
+        # A job whose grant outcome is unknown waits for an operator (see fulfillment.GrantOutcomeUnknown)
+        failed = (
+            select(FulfillmentJob.id)
+            .where(
+                FulfillmentJob.status == "failed",
+                FulfillmentJob.updated_at < now - timedelta(seconds=self.redrive_after),
+                FulfillmentJob.granted.is_(True) | FulfillmentJob.grant_started_at.is_(None),
+                FulfillmentJob.redrive_count < self.max_redrives,
+            )
+            .order_by(FulfillmentJob.updated_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        r = await db_session.execute(
+            update(FulfillmentJob)
+            .where(FulfillmentJob.id.in_(failed))
+            .values(
+                status="pending",
+                attempts=0,
+                redrive_count=FulfillmentJob.redrive_count + 1,
+                run_after=now,
+                locked_until=None,
+                updated_at=now,
+            )
+            .returning(FulfillmentJob.order_id, FulfillmentJob.redrive_count)
+        )
+        redriven = r.all()
+        if redriven:
+            logging.warning(f"Reconcile: re-driving failed fulfillment for order ids {[order_id for order_id, _ in redriven]}")
+        last = [order_id for order_id, count in redriven if count >= self.max_redrives]
+        if last:
+            logging.warning(f"Reconcile: last automatic re-drive for order ids {last}; if it fails again it needs an operator")
+        return len(redriven)
+
+    async def _redrive_notifications(self, db_session, now):
+        if not Config.BOT_PURCHASE_NOTIFY_BULK_URL:
+            return 0
+        r = await db_session.execute(
+            select(Order)
+            .where(
+                Order.notification_status == "failed",
+                Order.updated_at < now - timedelta(seconds=self.redrive_after),
+                ~exists().where(
+                    NotificationOutbox.order_id == Order.id, NotificationOutbox.redrive_count >= self.max_redrives
+                ),
+            )
+            .order_by(Order.updated_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        orders = r.scalars().all()
+        if not orders:
+            return 0
+        ids = [o.id for o in orders]
+        for order in orders:
+            # Orders notified before the outbox existed have no row yet; for the rest this is a no-op
+            await enqueue_notification(db_session, order)
+        await db_session.execute(
+            update(NotificationOutbox)
+            .where(NotificationOutbox.order_id.in_(ids), NotificationOutbox.status == "failed")
+            .values(status="pending", attempts=0, redrive_count=NotificationOutbox.redrive_count + 1, next_attempt_at=now)
+        )
+        await db_session.execute(
+            update(Order).where(Order.id.in_(ids)).values(notification_status="queued", notification_error=None, updated_at=now)
+        )
+        return len(ids)
+
+    def stats(self):
+        return dict(self._stats, running=self._task is not None)
+
+
+order_reconciler = OrderReconciler(
+    interval=Config.RECONCILE_INTERVAL,
+    batch_size=Config.RECONCILE_BATCH_SIZE,
+    pending_ttl=Config.PENDING_ORDER_TTL,
+    redrive_after=Config.RECONCILE_REDRIVE_AFTER,
+    paid_grace=Config.RECONCILE_PAID_GRACE,
+    lookback=Config.RECONCILE_LOOKBACK,
+    max_redrives=Config.RECONCILE_MAX_REDRIVES,
+)
+
+
+async def _main():
+    from async_db import async_engine
+
+    try:
+        counts = await order_reconciler.sweep_once()
+        print(counts if counts is not None else "another sweep is running, skipped")
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,85 @@
+"""Random card draws for pack grants, served from the in-memory catalog instead of scanning ``cards``."""
+import random
+import logging
+from collections import namedtuple
+
+from catalog import catalog
+
+ANY = None  # rarity group covering every card
+
+# A slot draws ``count`` cards: a rarity group is picked by weight, then a card uniformly within it
+PackSlot = namedtuple("PackSlot", ("count", "weights"))
+
+PACK_TABLES = {
+    "regular": (
+        PackSlot(3, {("EPISODICAL", "SECONDARY", "FAMOUS"): 1}),
+        PackSlot(1, {ANY: 1}),
+        PackSlot(1, {("MOVIE", "SERIES"): 1}),
+    ),
+    "rare": (
+        PackSlot(4, {ANY: 1}),
+        PackSlot(1, {("MOVIE", "SERIES"): 1}),
+    ),
+    "epic": (
+        PackSlot(2, {ANY: 1}),
+        PackSlot(3, {("MOVIE", "SERIES"): 1}),
+    ),
+}
+
+
+class CardSampler:
+    """
+    Keeps one id tuple per rarity group, rebuilt when the catalog snapshot changes,
+    so drawing k cards is O(k). Pass ``seed`` (or an ``rng`` per call) for reproducible draws.
+    """
+
+    def __init__(self, catalog, seed=None, tables=PACK_TABLES):
+        self.catalog = catalog
+        self.rng = random.Random(seed)
+        self.tables = tables
+        self._snapshot = None
+        self._groups = {}
+
+    async def _group_ids(self, rarities):
+        snap = await self.catalog.get()
+        if snap is not self._snapshot:
+            self._snapshot = snap
+            self._groups = {}
+        key = ANY if rarities is ANY else tuple(sorted(rarities))
+        ids = self._groups.get(key)
+        if ids is None:
+            if key is ANY:
+                ids = tuple(snap.cards_by_id)
+            else:
+                ids = tuple(cid for rarity in key for cid in snap.by_rarity.get(rarity, ()))
+            self._groups[key] = ids
+        return ids
+
+    async def sample(self, rarities, count, rng=None):
+        """``count`` card ids (with repeats) from the given rarities, or from all cards for ANY."""
+        if count <= 0:
+            return []
+        ids = await self._group_ids(rarities)
+        if not ids:
+            logging.warning("Sampler: no cards found for rarities=%r", rarities)
+            return []
+        return (rng or self.rng).choices(ids, k=count)
+
+    async def draw_pack(self, pack_type, rng=None):
+        """Card ids for one pack of ``pack_type``; raises KeyError for unknown packs."""
+        rng = rng or self.rng
+        drawn = []
+        for slot in self.tables[pack_type]:
+            groups = list(slot.weights)
+            if len(groups) == 1:
+                drawn.extend(await self.sample(groups[0], slot.count, rng))
+                continue
+            picks = rng.choices(groups, weights=[slot.weights[g] for g in groups], k=slot.count)
+            for group in groups:
+                n = picks.count(group)
+                if n:
+                    drawn.extend(await self.sample(group, n, rng))
+        return drawn
+
+
+card_sampler = CardSampler(catalog)
@@ -0,0 +1,203 @@
+"""Single queued writer connection to the bot's SQLite DB, with busy handling and lock-wait metrics."""
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+
+import aiosqlite
+
+from config import Config
+from async_db import SQLITE_DB_PATH
+
+# Upper bounds (ms) of the wait histograms; the last bucket is open-ended
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    __slots__ = ("counts", "total_ms", "max_ms", "n")
+
+    def __init__(self):
+        self.counts = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.n = 0
+
+    def observe(self, ms):
+        i = 0
+        while i < len(WAIT_BUCKETS_MS) and ms > WAIT_BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def as_dict(self):
+        labels = [f"<={b}ms" for b in WAIT_BUCKETS_MS] + [f">{WAIT_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.n,
+            "avg_ms": round(self.total_ms / self.n, 2) if self.n else None,
+            "max_ms": round(self.max_ms, 2),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+def is_busy_error(e):
+    if not isinstance(e, sqlite3.OperationalError):
+        return False
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+
+class SQLiteWriter:
+    """
+    Owns the one read/write connection the site uses on the bot DB. ``run(fn)`` queues
+    ``fn(conn)``; the worker opens ``BEGIN IMMEDIATE``, awaits ``fn`` and commits, so ``fn``
+    must only issue statements. A busy/locked DB (after ``busy_timeout``) rolls back and
+    retries the whole transaction with jittered exponential backoff, so ``fn`` must be
+    safe to re-run. Lock waits (BEGIN IMMEDIATE plus backoff) and queue waits are histogrammed.
+    """
+
+    def __init__(self, path, busy_timeout_ms=5000, max_retries=5, backoff=0.05, backoff_max=2.0):
+        self.path = path
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.journal_mode = None
+        self._conn = None
+        self._queue = None
+        self._worker = None
+        self._lock_wait = Histogram()
+        self._queue_wait = Histogram()
+        self._stats = {"transactions": 0, "retries": 0, "busy_failures": 0, "errors": 0}
+
+    async def _connect(self):
+        if self._conn is not None:
+            return self._conn
+        conn = await aiosqlite.connect(self.path)
+        await conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        cur = await conn.execute("PRAGMA journal_mode")
+        self.journal_mode = ((await cur.fetchone())[0] or "").lower()
+        if self.journal_mode != "wal":
+            # The bot owns the file; we only report it. Without WAL our write lock also blocks its readers.
+            logging.warning("SQLite writer: %s is in journal_mode=%s, not WAL", self.path, self.journal_mode)
+        self._conn = conn
+        return conn
+
+    def _ensure_worker(self):
+        # A restarted worker picks up what is already queued; the queue is never replaced
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._work())
+
+    async def run(self, fn):
+        """Runs ``fn(conn)`` inside one write transaction and returns its result."""
+        self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, fut, time.perf_counter()))
+        return await fut
+
+    async def _work(self):
+        while True:
+            fn, fut, queued_at = await self._queue.get()
+            self._queue_wait.observe((time.perf_counter() - queued_at) * 1000)
+            try:
+                result = await self._transaction(fn)
+            except asyncio.CancelledError:
+                if not fut.done():
+                    fut.cancel()
+                raise
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    async def _transaction(self, fn):
+        waited = 0.0
+        attempt = 0
+        while True:
+            conn = await self._connect()
+            started = time.perf_counter()
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+                waited += time.perf_counter() - started
+                self._lock_wait.observe(waited * 1000)
+                result = await fn(conn)
+                await conn.commit()
+                self._stats["transactions"] += 1
+                return result
+            except asyncio.CancelledError:
+                # Don't leave the connection inside BEGIN IMMEDIATE for the next worker
+                await self._rollback(conn)
+                raise
+            except Exception as e:
+                await self._rollback(conn)
+                if not is_busy_error(e):
+                    self._stats["errors"] += 1
+                    raise
+                waited += time.perf_counter() - started
+                if attempt >= self.max_retries:
+                    self._stats["busy_failures"] += 1
+                    self._lock_wait.observe(waited * 1000)
+                    raise
+                attempt += 1
+                self._stats["retries"] += 1
+                delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+                logging.info("SQLite writer: database busy, retry %s/%s in %.3fs", attempt, self.max_retries, delay)
+                await asyncio.sleep(delay)
+                waited += delay
+
+    async def _rollback(self, conn):
+        try:
+            await conn.rollback()
+        except Exception as e:
+            logging.warning(f"SQLite writer: rollback failed, reopening connection: {e}")
+            await self._reset()
+
+    async def _reset(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        # Nothing will run what is still queued: fail it instead of leaving callers waiting
+        while self._queue is not None and not self._queue.empty():
+            _, fut, _ = self._queue.get_nowait()
+            self._queue.task_done()
+            if not fut.done():
+                fut.set_exception(RuntimeError("SQLite writer is closed"))
+        await self._reset()
+
+    def stats(self):
+        return dict(
+            self._stats,
+            queued=self._queue.qsize() if self._queue is not None else 0,
+            journal_mode=self.journal_mode,
+            lock_wait=self._lock_wait.as_dict(),
+            queue_wait=self._queue_wait.as_dict(),
+        )
+
+
+sqlite_writer = SQLiteWriter(
+    SQLITE_DB_PATH,
+    busy_timeout_ms=Config.SQLITE_BUSY_TIMEOUT_MS,
+    max_retries=Config.SQLITE_WRITE_RETRIES,
+    backoff=Config.SQLITE_WRITE_BACKOFF,
+    backoff_max=Config.SQLITE_WRITE_BACKOFF_MAX,
+)
@@ -0,0 +1,78 @@
+"""
+Static file responses (card images and their variants, avatars, placeholder).
+
+``STATIC_DELIVERY`` picks who moves the bytes:
+- ``app``: streamed by the worker, ranges and conditional requests handled by Quart;
+- ``x-accel``: an empty response with ``X-Accel-Redirect`` so nginx sends the file from an
+  internal location (``STATIC_ACCEL_PREFIX/<alias>/<file>``) with sendfile;
+- ``x-sendfile``: the same with ``X-Sendfile: <absolute path>`` (Apache mod_xsendfile, lighttpd).
+In the proxy modes Range / If-None-Match / If-Modified-Since are answered by the proxy.
+"""
+import os
+import logging
+import mimetypes
+
+from quart import Response as QuartResponse, current_app, send_file
+from quart.wrappers.response import FileBody
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from config import Config
+
+MODES = ("app", "x-accel", "x-sendfile")
+
+
+class _LargeChunkFileBody(FileBody):
+    """
+    FileBody with bigger reads that tracks its own offset: every aiofiles call is a thread
+    round trip, and the stock body makes two (tell + read) per 8 KiB.
+    """
+
+    buffer_size = 256 * 1024
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        self._pos = self.begin
+        return self
+
+    async def __anext__(self):
+        if self._pos >= self.end:
+            raise StopAsyncIteration()
+        chunk = await self.file.read(min(self.buffer_size, self.end - self._pos))
+        if not chunk:
+            raise StopAsyncIteration()
+        self._pos += len(chunk)
+        return chunk
+
+
+class Response(QuartResponse):
+    file_body_class = _LargeChunkFileBody
+
+
+def delivery_mode():
+    mode = (Config.STATIC_DELIVERY or "app").lower()
+    if mode not in MODES:
+        logging.warning(f"Unknown STATIC_DELIVERY={mode!r}, serving files from the app")
+        return "app"
+    return mode
+
+
+async def send_static(directory, filename, alias, mimetype=None):
+    """
+    Response for ``directory/filename`` in the configured delivery mode; ``alias`` names the
+    directory in the proxy's internal location. Raises NotFound like send_from_directory.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    mode = delivery_mode()
+    if mode == "app":
+        return await send_file(path, mimetype=mimetype, conditional=True)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = current_app.response_class("", mimetype=mimetype)
+    if mode == "x-accel":
+        response.headers["X-Accel-Redirect"] = f"{Config.STATIC_ACCEL_PREFIX.rstrip('/')}/{alias}/{filename}"
+    else:
+        response.headers["X-Sendfile"] = os.path.abspath(path)
+    return response
@@ -0,0 +1,104 @@
+"""
+Card image uploads: the uploaded part is copied in chunks into a temp file next to its
+destination, its type is taken from the magic bytes, and it is moved into place with an
+atomic rename. All file work runs in a worker thread, never on the event loop.
+"""
+import os
+import asyncio
+import logging
+import tempfile
+
+from config import Config
+
+CARD_IMG_DIR = "card_imgs"
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes -> extension the file is stored under
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedImage(Exception):
+    pass
+
+
+def sniff_image_type(head: bytes):
+    """Extension for a PNG/JPEG/GIF by its signature, or None."""
+    for magic, ext in _SIGNATURES:
+        if head.startswith(magic):
+            return ext
+    return None
+
+
+def _store(src, directory, stem, max_bytes):
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            first = src.read(CHUNK_SIZE)
+            ext = sniff_image_type(first)
+            if ext is None:
+                raise UnsupportedImage("not a PNG, JPEG or GIF image")
+            size = 0
+            chunk = first
+            while chunk:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"image is larger than {max_bytes} bytes")
+                dst.write(chunk)
+                chunk = src.read(CHUNK_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.chmod(tmp_path, 0o644)
+        filename = stem + ext
+        os.replace(tmp_path, os.path.join(directory, filename))
+        return filename
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+async def save_card_image(file_storage, card_uuid, max_bytes=None):
+    """
+    Stores an uploaded image as card_imgs/<card_uuid>.<ext>; returns the file name.
+    Raises UnsupportedImage if the content is not PNG/JPEG/GIF, UploadTooLarge past ``max_bytes``.
+    """
+    max_bytes = Config.CARD_IMAGE_MAX_BYTES if max_bytes is None else max_bytes
+    return await asyncio.to_thread(_store, file_storage.stream, CARD_IMG_DIR, str(card_uuid), max_bytes)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def remove_card_image(filename):
+    if not filename:
+        return
+    try:
+        await asyncio.to_thread(_remove, os.path.join(CARD_IMG_DIR, os.path.basename(filename)))
+    except OSError as e:
+        logging.warning(f"Failed to remove card image {filename}: {e}")
+
+
+def limit_upload(request, max_bytes=None):
+    """
+    Caps the request body for an upload route (image plus form overhead) before the form
+    is parsed; returns True if the declared Content-Length is already over the cap.
+    """
+    max_bytes = Config.CARD_IMAGE_MAX_BYTES if max_bytes is None else max_bytes
+    limit = max_bytes + 64 * 1024
+    request.max_content_length = limit
+    return request.content_length is not None and request.content_length > limit
@@ -1,20 +1,11 @@
 // src/api/index.js
 import axios from 'axios'
 
-// Fetch all seasons
+// Fetch all seasons (with card counts) in a single request
 export const fetchSeasons = async () => {
-  const response = await fetch('/api/seasons')
+  const response = await fetch('/api/catalog')
   if (!response.ok) throw new Error('Не удалось получить список сезонов')
-  const seasonIds = await response.json()
-
-  const seasons = await Promise.all(
-    seasonIds.map(async seasonId => {
-      const seasonResponse = await fetch(`/api/season_info/${seasonId}`)
-      if (!seasonResponse.ok) throw new Error('Не удалось получить информацию о сезоне')
-      return seasonResponse.json()
-    })
-  )
-  
+  const { seasons } = await response.json()
   return seasons
 }
 
@@ -47,6 +38,17 @@ export async function fetchCardsForSeason(seasonId, sortField = 'id', sortDirect
   }
 }
 
+// Fetch one page of cards for a season.
+// Returns { cards, next_cursor }; pass next_cursor back to get the following page (null = last page).
+// `fields` is an optional list of columns to return (id is always included).
+export async function fetchCardsPage(seasonId, { sortField = 'id', sortDirection = 'asc', limit = 50, cursor = null, fields = null } = {}) {
+  const params = { sort: sortField, direction: sortDirection, limit }
+  if (cursor) params.cursor = cursor
+  if (fields) params.fields = fields.join(',')
+  const response = await axios.get(`/api/cards/${seasonId}`, { params })
+  return response.data
+}
+
 // Fetch detailed card info
 export const fetchCardInfo = async (cardId) => {
   const response = await fetch(`/api/card_info/${cardId}`)
@@ -54,6 +56,13 @@ export const fetchCardInfo = async (cardId) => {
   return response.json()
 }
 
+// Fetch info for several cards in one request (unknown ids are skipped)
+export const fetchCardInfos = async (cardIds) => {
+  const response = await fetch(`/api/card_info?ids=${cardIds.join(',')}`)
+  if (!response.ok) throw new Error('Не удалось получить информацию о карточках')
+  return response.json()
+}
+
 // Fetch season info
 export const fetchSeasonInfo = async (seasonId) => {
   const response = await fetch(`/api/season_info/${seasonId}`)
@@ -58,12 +58,8 @@ export default createStore({
       commit('SET_LOADING', true)
       commit('SET_ERROR', null)
       try {
-        const response = await fetch('/api/seasons');
-        if (!response.ok) throw new Error('Не удалось получить список сезонов');
-        const seasonIds = await response.json();
-        const seasonPromises = seasonIds.map(id => fetch(`/api/season_info/${id}`).then(res => res.json()));
-        const orderedSeasonsData = await Promise.all(seasonPromises);
-        commit('SET_SEASONS', orderedSeasonsData);
+        const seasons = await fetchSeasons();
+        commit('SET_SEASONS', seasons);
       } catch (error) {
         commit('SET_ERROR', error)
         console.error('Ошибка получения сезонов:', error)
@@ -3,49 +3,44 @@ Purchase notify service: receives webhook from the website backend and sends
 a Telegram message to the user via the game bot. Does not grant items.
 """
 import os
+import uuid
 import logging
 from aiohttp import web
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
 
+from ratelimit import SendLimiter
+from spool import Spool
+from scheduler import SendScheduler
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("PURCHASE_NOTIFY_BOT_TOKEN") or os.getenv("CW_BOT_TOKEN")
 WEBHOOK_SECRET = (os.getenv("PURCHASE_WEBHOOK_SECRET") or os.getenv("BOT_PURCHASE_WEBHOOK_SECRET") or "").strip()
+# Spool of accepted-but-undelivered messages plus delivered ids (dedup); keep it on a volume
+STATE_DB = os.getenv("NOTIFY_STATE_DB", "purchase_notify.db")
+SENT_TTL_DAYS = int(os.getenv("NOTIFY_SENT_TTL_DAYS", "30"))
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))
+SENDER_WORKERS = int(os.getenv("NOTIFY_SENDER_WORKERS", "8"))
+MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "8"))
+MAX_BULK_MESSAGES = int(os.getenv("NOTIFY_MAX_BULK_MESSAGES", "500"))
 
 
-async def handle_purchase(request: web.Request) -> web.Response:
-    if request.method != "POST":
-        return web.Response(status=405, text="Method not allowed")
-
+def _check_auth(request: web.Request):
     if WEBHOOK_SECRET:
         auth = request.headers.get("Authorization", "")
         if auth != f"Bearer {WEBHOOK_SECRET}":
             logger.warning("Purchase webhook: invalid or missing Authorization")
             return web.Response(status=401, text="Unauthorized")
+    return None
 
-    try:
-        data = await request.json()
-    except Exception as e:
-        logger.warning("Purchase webhook: invalid JSON: %s", e)
-        return web.Response(status=400, text="Invalid JSON")
 
-    event = data.get("event")
-    user_id = data.get("user_id")
+def build_message(data: dict) -> str:
     items = data.get("items", [])
     total_amount = data.get("total_amount", "")
     currency = data.get("currency", "RUB")
-
-    if event != "purchase_complete" or not user_id:
-        logger.warning("Purchase webhook: invalid payload event=%s user_id=%s", event, user_id)
-        return web.Response(status=400, text="Invalid payload")
-
-    if not BOT_TOKEN:
-        logger.error("PURCHASE_NOTIFY_BOT_TOKEN or CW_BOT_TOKEN not set")
-        return web.Response(status=500, text="Bot not configured")
-
-    # Build message
     lines = ["🎉 <b>Оплата прошла успешно!</b>\n"]
     lines.append("Ваш заказ оплачен. Выдачу товаров в боте обработают вручную или через вашу систему.\n")
     if items:
@@ -53,30 +48,158 @@ async def handle_purchase(request: web.Request) -> web.Response:
         for it in items:
             name = it.get("name", "—")
             qty = int(it.get("quantity", 1))
-            price = it.get("price")
             if qty > 1:
                 lines.append(f"• {name} × {qty}")
             else:
                 lines.append(f"• {name}")
         if total_amount:
             lines.append(f"\n<b>Сумма:</b> {total_amount} {currency}")
+    return "\n".join(lines)
+
+
+def _valid(data) -> bool:
+    return isinstance(data, dict) and data.get("event") == "purchase_complete" and bool(data.get("user_id"))
+
+
+def _message_id(data: dict) -> str:
+    if data.get("message_id"):
+        return str(data["message_id"])
+    if data.get("order_number"):
+        return f"order:{data['order_number']}"
+    return f"anon:{uuid.uuid4().hex}"
+
+
+async def handle_purchase(request: web.Request) -> web.Response:
+    if request.method != "POST":
+        return web.Response(status=405, text="Method not allowed")
+
+    denied = _check_auth(request)
+    if denied:
+        return denied
+
+    try:
+        data = await request.json()
+    except Exception as e:
+        logger.warning("Purchase webhook: invalid JSON: %s", e)
+        return web.Response(status=400, text="Invalid JSON")
+
+    event = data.get("event")
+    user_id = data.get("user_id")
+    if event != "purchase_complete" or not user_id:
+        logger.warning("Purchase webhook: invalid payload event=%s user_id=%s", event, user_id)
+        return web.Response(status=400, text="Invalid payload")
+
+    if request.app["bot"] is None:
+        logger.error("PURCHASE_NOTIFY_BOT_TOKEN or CW_BOT_TOKEN not set")
+        return web.Response(status=500, text="Bot not configured")
 
-    text = "\n".join(lines)
+    status = request.app["scheduler"].submit(_message_id(data), data)
+    return web.Response(status=202, text=status.upper())
 
+
+async def handle_purchase_bulk(request: web.Request) -> web.Response:
+    """
+    POST {"messages": [<purchase payload> + "message_id", ...]} ->
+    {"results": [{"message_id", "status", ["retry_after"], ["error"]}, ...]}, one ack per message.
+    """
+    denied = _check_auth(request)
+    if denied:
+        return denied
     try:
-        bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-        await bot.send_message(chat_id=user_id, text=text)
-        await bot.session.close()
+        data = await request.json()
+        messages = data["messages"]
+        if not isinstance(messages, list):
+            raise ValueError("messages must be a list")
     except Exception as e:
-        logger.exception("Failed to send Telegram message to %s: %s", user_id, e)
-        return web.Response(status=500, text="Failed to send message")
+        logger.warning("Purchase bulk webhook: invalid body: %s", e)
+        return web.Response(status=400, text="Invalid JSON")
+    if len(messages) > MAX_BULK_MESSAGES:
+        return web.Response(status=413, text=f"At most {MAX_BULK_MESSAGES} messages per request")
+    if request.app["bot"] is None:
+        logger.error("PURCHASE_NOTIFY_BOT_TOKEN or CW_BOT_TOKEN not set")
+        return web.Response(status=500, text="Bot not configured")
+
+    scheduler = request.app["scheduler"]
+    results = []
+    for m in messages:
+        if not _valid(m) or not m.get("message_id"):
+            results.append({"message_id": m.get("message_id") if isinstance(m, dict) else None, "status": "failed", "error": "invalid payload"})
+            continue
+        results.append({"message_id": m["message_id"], "status": scheduler.submit(str(m["message_id"]), m)})
+    logger.info(
+        "Purchase bulk webhook: %d messages, %d accepted",
+        len(results),
+        sum(1 for r in results if r["status"] == "accepted"),
+    )
+    return web.json_response({"results": results}, status=202)
+
+
+async def handle_purchase_status(request: web.Request) -> web.Response:
+    """
+    POST {"message_ids": [...]} -> {"results": [{"message_id", "status", ["error"]}, ...]}, where status is
+    sent, pending (spooled, not delivered yet), dropped (given up on; submitting it again retries) or unknown.
+    """
+    denied = _check_auth(request)
+    if denied:
+        return denied
+    try:
+        data = await request.json()
+        message_ids = data["message_ids"]
+        if not isinstance(message_ids, list):
+            raise ValueError("message_ids must be a list")
+    except Exception as e:
+        logger.warning("Purchase status: invalid body: %s", e)
+        return web.Response(status=400, text="Invalid JSON")
+    if len(message_ids) > MAX_BULK_MESSAGES:
+        return web.Response(status=413, text=f"At most {MAX_BULK_MESSAGES} message ids per request")
+    results = []
+    for message_id in message_ids:
+        status, reason = request.app["spool"].status(str(message_id))
+        result = {"message_id": message_id, "status": status}
+        if reason:
+            result["error"] = reason
+        results.append(result)
+    return web.json_response({"results": results})
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.json_response(request.app["scheduler"].stats())
+
+
+async def on_startup(app: web.Application) -> None:
+    # One Bot (and one aiohttp session to the Bot API) for the whole process
+    app["bot"] = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML")) if BOT_TOKEN else None
+    app["spool"] = Spool(STATE_DB, sent_ttl_days=SENT_TTL_DAYS)
+
+    async def send(data):
+        await app["bot"].send_message(chat_id=data["user_id"], text=build_message(data))
+
+    app["scheduler"] = SendScheduler(
+        send,
+        app["spool"],
+        SendLimiter(global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE),
+        workers=SENDER_WORKERS,
+        max_attempts=MAX_ATTEMPTS,
+    )
+    if app["bot"] is not None:
+        await app["scheduler"].start()
+
 
-    return web.Response(status=200, text="OK")
+async def on_cleanup(app: web.Application) -> None:
+    await app["scheduler"].stop()
+    if app["bot"] is not None:
+        await app["bot"].session.close()
+    app["spool"].close()
 
 
 def create_app() -> web.Application:
     app = web.Application()
     app.router.add_post("/webhook/purchase", handle_purchase)
+    app.router.add_post("/webhook/purchase/bulk", handle_purchase_bulk)
+    app.router.add_post("/webhook/purchase/status", handle_purchase_status)
+    app.router.add_get("/metrics", handle_metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
     return app
 
 
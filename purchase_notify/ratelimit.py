@@ -0,0 +1,77 @@
+"""Token buckets for Telegram's send limits (about 30 messages/s per bot, 1 message/s per chat)."""
+import time
+import asyncio
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        """Takes one token, sleeping until it is available; returns the time waited."""
+        waited = 0.0
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return waited
+            delay = (1 - self.tokens) / self.rate
+            waited += delay
+            await asyncio.sleep(delay)
+
+
+class SendLimiter:
+    """
+    Global bucket plus one bucket per chat. ``pause`` holds every sender back after a
+    flood-control reply (Telegram's ``retry_after``).
+    """
+
+    IDLE_CHAT_TTL = 60.0
+
+    def __init__(self, global_rate: float = 25.0, global_burst: float = 25.0, per_chat_rate: float = 1.0, per_chat_burst: float = 1.0):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self._chats = {}
+        self._paused_until = 0.0
+        self._last_prune = time.monotonic()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        now = time.monotonic()
+        if now - self._last_prune > self.IDLE_CHAT_TTL:
+            self._last_prune = now
+            idle = [cid for cid, b in self._chats.items() if now - b.updated > self.IDLE_CHAT_TTL and cid != chat_id]
+            for cid in idle:
+                del self._chats[cid]
+        return bucket
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id) -> float:
+        """Waits for a send slot for ``chat_id``; returns the time waited."""
+        waited = await self._chat_bucket(chat_id).acquire()
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            waited += pause
+            await asyncio.sleep(pause)
+        return waited + await self.global_bucket.acquire()
+
+    def stats(self) -> dict:
+        return {
+            "tracked_chats": len(self._chats),
+            "paused_for": max(0.0, round(self._paused_until - time.monotonic(), 3)),
+        }
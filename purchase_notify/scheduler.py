@@ -0,0 +1,151 @@
+"""In-process send queue: a pool of senders under the rate limits, backed by the spool."""
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class _Item:
+    __slots__ = ("message_id", "payload", "attempts", "accepted_at")
+
+    def __init__(self, message_id, payload, attempts=0):
+        self.message_id = message_id
+        self.payload = payload
+        self.attempts = attempts
+        self.accepted_at = time.monotonic()
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))], 1)
+
+
+class SendScheduler:
+    """
+    ``submit`` spools a message and queues it; ``workers`` sender tasks take messages off the
+    queue, wait for a slot in the SendLimiter and call ``send(payload)``. Flood control
+    (``retry_after``) pauses every sender and requeues the message after the pause; other
+    transient errors back off exponentially up to ``max_attempts``. Blocked bots / unknown
+    chats are dropped. Whatever is still spooled on restart is queued again by ``start``.
+    """
+
+    def __init__(self, send, spool, limiter, workers=8, max_attempts=8, retry_base=2.0, retry_max=300.0):
+        self.send = send
+        self.spool = spool
+        self.limiter = limiter
+        self.workers = max(1, int(workers))
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._queue = None
+        self._tasks = []
+        self._delayed = set()
+        self._api_ms = deque(maxlen=1024)
+        self._end_to_end_ms = deque(maxlen=1024)
+        self._stats = {"accepted": 0, "duplicates": 0, "sent": 0, "retried": 0, "rate_limited": 0, "dropped": 0}
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        resumed = self.spool.pending()
+        for message_id, payload, attempts in resumed:
+            self._queue.put_nowait(_Item(message_id, payload, attempts))
+        if resumed:
+            logger.info("Send scheduler: resumed %d spooled messages", len(resumed))
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for handle in self._delayed:
+            handle.cancel()
+        self._delayed.clear()
+        for task in tasks:
+            task.cancel()
+        # Undelivered messages stay in the spool
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, message_id, payload):
+        """Returns "accepted", or "duplicate" when the id is already spooled or delivered."""
+        if not self.spool.accept(message_id, payload):
+            self._stats["duplicates"] += 1
+            return "duplicate"
+        self._stats["accepted"] += 1
+        self._queue.put_nowait(_Item(message_id, payload))
+        return "accepted"
+
+    def _requeue(self, item, delay):
+        loop = asyncio.get_running_loop()
+
+        def put():
+            self._delayed.discard(handle)
+            self._queue.put_nowait(item)
+
+        handle = loop.call_later(delay, put)
+        self._delayed.add(handle)
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._deliver(item)
+            except Exception as e:
+                logger.exception("Send scheduler: unexpected error for %s: %s", item.message_id, e)
+                self._requeue(item, self.retry_base)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, item):
+        chat_id = item.payload.get("user_id")
+        await self.limiter.acquire(chat_id)
+        item.attempts += 1
+        started = time.monotonic()
+        try:
+            await self.send(item.payload)
+        except TelegramRetryAfter as e:
+            # Flood control is not the message's fault: no attempt is charged
+            item.attempts -= 1
+            self._stats["rate_limited"] += 1
+            self.limiter.pause(e.retry_after)
+            self._requeue(item, e.retry_after)
+            return
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            self._drop(item, f"permanent error: {e}")
+            return
+        except Exception as e:
+            if item.attempts >= self.max_attempts:
+                self._drop(item, f"giving up after {item.attempts} attempts: {e}")
+                return
+            delay = min(self.retry_max, self.retry_base * 2 ** (item.attempts - 1)) * random.uniform(0.8, 1.2)
+            logger.warning("Send scheduler: %s failed (attempt %d), retry in %.1fs: %s", item.message_id, item.attempts, delay, e)
+            self.spool.record_attempt(item.message_id, item.attempts)
+            self._stats["retried"] += 1
+            self._requeue(item, delay)
+            return
+        now = time.monotonic()
+        self._api_ms.append((now - started) * 1000)
+        self._end_to_end_ms.append((now - item.accepted_at) * 1000)
+        self.spool.mark_sent(item.message_id)
+        self._stats["sent"] += 1
+
+    def _drop(self, item, reason):
+        logger.warning("Send scheduler: dropping %s for chat %s: %s", item.message_id, item.payload.get("user_id"), reason)
+        self.spool.drop(item.message_id, reason)
+        self._stats["dropped"] += 1
+
+    def stats(self):
+        return dict(
+            self._stats,
+            queue_depth=self._queue.qsize() if self._queue is not None else 0,
+            delayed=len(self._delayed),
+            spooled=self.spool.size(),
+            workers=len(self._tasks),
+            send_ms={"p50": _percentile(self._api_ms, 0.5), "p95": _percentile(self._api_ms, 0.95)},
+            end_to_end_ms={"p50": _percentile(self._end_to_end_ms, 0.5), "p95": _percentile(self._end_to_end_ms, 0.95)},
+            limiter=self.limiter.stats(),
+        )
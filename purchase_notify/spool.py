@@ -0,0 +1,82 @@
+"""Local SQLite spool: accepted-but-undelivered messages, the ids already delivered and the ones given up on."""
+import json
+import time
+import sqlite3
+
+
+class Spool:
+    """
+    ``pending`` holds every accepted message until it is delivered or given up on, so a
+    restart resumes where the process stopped; ``sent`` remembers delivered ids for dedup;
+    ``dropped`` remembers ids given up on (with the reason) until they are submitted again.
+    Calls are tiny single-row statements on a local file, made straight from the event loop.
+    """
+
+    def __init__(self, path: str, sent_ttl_days: int = 30):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending ("
+            "message_id TEXT PRIMARY KEY, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "accepted_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sent (message_id TEXT PRIMARY KEY, sent_at REAL NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dropped (message_id TEXT PRIMARY KEY, reason TEXT, dropped_at REAL NOT NULL)"
+        )
+        cutoff = time.time() - sent_ttl_days * 86400
+        self.conn.execute("DELETE FROM sent WHERE sent_at < ?", (cutoff,))
+        self.conn.execute("DELETE FROM dropped WHERE dropped_at < ?", (cutoff,))
+        self.conn.commit()
+
+    def accept(self, message_id: str, payload: dict) -> bool:
+        """Spools a message; False if it is already spooled or was delivered before (a dropped one is retried)."""
+        if self.conn.execute("SELECT 1 FROM sent WHERE message_id = ?", (message_id,)).fetchone():
+            return False
+        with self.conn:
+            self.conn.execute("DELETE FROM dropped WHERE message_id = ?", (message_id,))
+            cur = self.conn.execute(
+                "INSERT OR IGNORE INTO pending (message_id, payload, accepted_at) VALUES (?, ?, ?)",
+                (message_id, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        return cur.rowcount == 1
+
+    def pending(self):
+        """(message_id, payload, attempts) for everything still undelivered, oldest first."""
+        rows = self.conn.execute("SELECT message_id, payload, attempts FROM pending ORDER BY accepted_at").fetchall()
+        return [(mid, json.loads(payload), attempts) for mid, payload, attempts in rows]
+
+    def record_attempt(self, message_id: str, attempts: int) -> None:
+        self.conn.execute("UPDATE pending SET attempts = ? WHERE message_id = ?", (attempts, message_id))
+        self.conn.commit()
+
+    def mark_sent(self, message_id: str) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM pending WHERE message_id = ?", (message_id,))
+            self.conn.execute("INSERT OR IGNORE INTO sent (message_id, sent_at) VALUES (?, ?)", (message_id, time.time()))
+
+    def drop(self, message_id: str, reason: str = "") -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM pending WHERE message_id = ?", (message_id,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dropped (message_id, reason, dropped_at) VALUES (?, ?, ?)",
+                (message_id, reason[:512], time.time()),
+            )
+
+    def status(self, message_id: str):
+        """("sent" | "pending" | "dropped" | "unknown", reason or None) for one id."""
+        if self.conn.execute("SELECT 1 FROM sent WHERE message_id = ?", (message_id,)).fetchone():
+            return "sent", None
+        if self.conn.execute("SELECT 1 FROM pending WHERE message_id = ?", (message_id,)).fetchone():
+            return "pending", None
+        row = self.conn.execute("SELECT reason FROM dropped WHERE message_id = ?", (message_id,)).fetchone()
+        if row:
+            return "dropped", row[0]
+        return "unknown", None
+
+    def size(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()